@@ -1,360 +1,267 @@
 import streamlit as st
-import pandas as pd
 import pickle
 import os
-import glob
+import shutil
+import tempfile
+import threading
+import time
 from datetime import datetime
 from io import BytesIO
-from openpyxl import load_workbook
-from openpyxl.styles import PatternFill, Font, Alignment, Border, Side
-from openpyxl.utils import get_column_letter
-import openpyxl
-import tempfile
+from preset_store import (
+    PRESET_STORE_DIR, read_manifest, load_preset_preview, get_preset_index, cached_preset_index,
+    lookup_preset_snapshot, publish_preset_snapshot, current_snapshot_dir, current_snapshot_version,
+    previous_snapshot_version, list_preset_snapshots, rollback_preset_snapshot,
+    deactivate_preset_snapshots, migrate_flat_preset_store, DEFAULT_RETENTION_SECONDS,
+    compact_preset_df, dataframe_memory_mb, read_preset_excel,
+)
+from run_history import new_run_record, record_run, load_run_history, last_input_headers
 
 # Constants
+# Single-file preset database written by earlier versions, migrated on startup
 PRESET_DB_PATH = "preset_db.pkl"
+# Result bundles are written to temporary directories with this prefix; those
+# of closed sessions are removed once they are older than RESULTS_MAX_AGE_HOURS
+RESULTS_DIR_PREFIX = "pim_results_"
+RESULTS_MAX_AGE_HOURS = 12
 
-def load_preset_db():
-    """Load the preset database from file if it exists."""
-    if os.path.exists(PRESET_DB_PATH):
-        with open(PRESET_DB_PATH, 'rb') as f:
-            return pickle.load(f)
-    return None
+def preset_db_exists():
+    """Return True if a current preset snapshot is available."""
+    return current_snapshot_version(PRESET_STORE_DIR) is not None
 
 def cleanup_old_preset_files():
-    """Remove old preset Excel and PKL files (except preset_db.pkl)."""
+    """Remove old preset Excel and PKL files from the app folder."""
+    import glob
+
     app_dir = os.path.dirname(os.path.abspath(__file__))
     patterns = ['*.pkl', '*.xlsx', '*.xlsm', '*.xltx', '*.xltm']
     removed = []
     for pattern in patterns:
         for filepath in glob.glob(os.path.join(app_dir, pattern)):
-            filename = os.path.basename(filepath)
-            # Keep only preset_db.pkl, remove all other pkl/excel files
-            if filename != 'preset_db.pkl':
-                try:
-                    os.remove(filepath)
-                    removed.append(filename)
-                except Exception:
-                    pass
+            try:
+                os.remove(filepath)
+                removed.append(os.path.basename(filepath))
+            except Exception:
+                pass
     return removed
 
 def save_preset_db(df):
-    """Save the preset database to file and cleanup old files."""
+    """Compact and save the preset database to file and cleanup old files.
+
+    Returns a dict with the memory usage (MB) before and after compaction.
+    """
+    memory_before = dataframe_memory_mb(df)
+    df = compact_preset_df(df)
+    memory_after = dataframe_memory_mb(df)
     # Cleanup old preset files first
     cleanup_old_preset_files()
-    # Save new preset
-    with open(PRESET_DB_PATH, 'wb') as f:
-        pickle.dump(df, f)
+    # Publish new preset as a versioned snapshot of key-partitioned shards
+    version = publish_preset_snapshot(df, PRESET_STORE_DIR)
+    return {'before_mb': memory_before, 'after_mb': memory_after, 'rows': len(df), 'version': version}
+
+def migrate_legacy_preset_db():
+    """Convert preset databases from earlier versions into a snapshot."""
+    if preset_db_exists():
+        return
+    if migrate_flat_preset_store(PRESET_STORE_DIR):
+        return
+    if not os.path.exists(PRESET_DB_PATH):
+        return
+    with open(PRESET_DB_PATH, 'rb') as f:
+        df = pickle.load(f)
+    publish_preset_snapshot(compact_preset_df(df), PRESET_STORE_DIR)
+    os.remove(PRESET_DB_PATH)
+
+@st.cache_resource
+def sweep_stale_results_on_startup():
+    """Sweep stale result directories once per server process."""
+    return sweep_stale_results()
+
+@st.cache_resource
+def preset_warmup_state():
+    """Process-wide warm-up state shared by all sessions; the index itself is in preset_store."""
+    return {'lock': threading.Lock(), 'target': None, 'thread': None, 'error': None}
+
+def _warm_up_preset_index(state, preset_dir):
+    """Import the processing libraries and build the preset key index."""
+    try:
+        # Importing here moves their start-up cost off the first request
+        import pandas  # noqa: F401
+        import openpyxl  # noqa: F401
+        get_preset_index(preset_dir)
+    except Exception as e:
+        with state['lock']:
+            if state['target'] == preset_dir:
+                state['error'] = str(e)
+
+def start_preset_warmup():
+    """Build the index of the current preset snapshot in a background thread.
+
+    Does nothing if the index is already built or being built for it.
+    """
+    state = preset_warmup_state()
+    preset_dir = current_snapshot_dir(PRESET_STORE_DIR)
+    with state['lock']:
+        if preset_dir is None or state['target'] == preset_dir:
+            return state
+        state['target'] = preset_dir
+        state['error'] = None
+        state['thread'] = threading.Thread(
+            target=_warm_up_preset_index, args=(state, preset_dir), daemon=True
+        )
+        state['thread'].start()
+    return state
+
+def save_run_record(record):
+    """Append a run to the history store without failing the run itself."""
+    try:
+        record_run(record)
+    except Exception:
+        pass
+
+def expected_input_headers():
+    """Return the input header rows of the last successful run, if any."""
+    try:
+        return last_input_headers()
+    except Exception:
+        return {'pim_header': None, 'part_data_header': None}
+
+def preflight_report(uploaded_file, check, *args):
+    """Run a pre-flight check once per uploaded file and keep the report in the session."""
+    reports = st.session_state.setdefault('preflight_reports', {})
+    key = (check.__name__, uploaded_file.file_id, repr(args))
+    if key not in reports:
+        reports[key] = check(uploaded_file, *args)
+    return reports[key]
+
+def show_preflight_report(report):
+    """Show the errors and warnings of a pre-flight report."""
+    for error in report['errors']:
+        st.error(f"❌ {error}")
+    for warning in report['warnings']:
+        st.warning(f"⚠️ {warning}")
+    if not report['errors'] and not report['warnings']:
+        st.success(
+            f"✅ {report['kind']} layout OK · {max(report['rows'] - 1, 0):,} rows × {report['cols']} columns "
+            f"(checked in {report['seconds']:.2f} s)"
+        )
+
+def clear_results():
+    """Delete the result bundle of the previous run from disk and the session."""
+    results = st.session_state.get('results')
+    if results:
+        shutil.rmtree(results['dir'], ignore_errors=True)
+    st.session_state.results = None
+    st.session_state.process_complete = False
+
+def sweep_stale_results(max_age_hours=RESULTS_MAX_AGE_HOURS):
+    """Remove result directories left behind by sessions that were closed."""
+    temp_dir = tempfile.gettempdir()
+    cutoff = time.time() - max_age_hours * 3600
+    removed = []
+    for name in os.listdir(temp_dir):
+        path = os.path.join(temp_dir, name)
+        if not name.startswith(RESULTS_DIR_PREFIX) or not os.path.isdir(path):
+            continue
+        try:
+            if os.path.getmtime(path) < cutoff:
+                shutil.rmtree(path)
+                removed.append(name)
+        except OSError:
+            pass
+    return removed
+
+def run_full_process(pim_file_bytes, part_data_file_bytes, progress_bar, status_text, engine=None, input_headers=None):
+    """Run the full PIM processing workflow and record it in the run history.
+
+    engine forces one of the pipeline engines; by default the execution
+    planner picks one from the size of the uploads. input_headers are the
+    header rows found by the pre-flight checks, recorded so later uploads
+    can be compared with them.
+
+    The processed PIM workbook and the DK Preset workbook(s), split at
+    Excel's row limit, are bundled into one zip in a temporary directory.
+    Returns the results dict of that bundle, or None on failure.
+    """
+    from pim_engine import run_pipeline, MODE_AUTO
+    from delivery import write_preset_parts, write_zip_bundle
+
+    record = new_run_record()
+    record['pim_bytes'] = len(pim_file_bytes)
+    record['part_data_bytes'] = len(part_data_file_bytes)
+    record.update(input_headers or {})
+    run_started = time.perf_counter()
+    results_dir = None
 
-def run_full_process(pim_file_bytes, part_data_file_bytes, progress_bar, status_text):
-    """Run the full PIM processing workflow."""
     try:
-        # Load preset DB
-        preset_df = load_preset_db()
-        if preset_df is None:
+        # Pin the current preset snapshot; only the shards needed in Step 11 are loaded later
+        preset_dir = current_snapshot_dir(PRESET_STORE_DIR)
+        if preset_dir is None:
             status_text.error("No preset database found. Please upload one in the Settings page.")
-            return None, None
+            return None
+        record['preset_version'] = os.path.basename(preset_dir)
 
-        # Save uploaded files to temp files for openpyxl
-        with tempfile.NamedTemporaryFile(delete=False, suffix='.xlsx') as tmp_pim:
-            tmp_pim.write(pim_file_bytes)
-            pim_file = tmp_pim.name
-        
-        with tempfile.NamedTemporaryFile(delete=False, suffix='.xlsx') as tmp_part:
-            tmp_part.write(part_data_file_bytes)
-            part_data_file = tmp_part.name
-
-        # Step 1: Load PIM file
-        status_text.info("Loading PIM file...")
-        progress_bar.progress(10)
-        wb = load_workbook(pim_file)
-        ws = wb.worksheets[0]
-        max_row = ws.max_row
-
-        # --- Step 1: Move columns N and O to R and S ---
-        cols_to_move = [14, 15]  # N, O
-        moved_data = []
-        for col_idx in cols_to_move:
-            col_data = []
-            for row in ws.iter_rows(min_row=1, max_row=max_row, min_col=col_idx, max_col=col_idx):
-                cell = row[0]
-                col_data.append({
-                    'value': cell.value,
-                    'style': cell._style,
-                    'number_format': cell.number_format,
-                    'has_formula': cell.data_type == 'f',
-                    'formula': cell.value if cell.data_type == 'f' else None
-                })
-            moved_data.append(col_data)
-
-        ws.delete_cols(15)
-        ws.delete_cols(14)
-        ws.insert_cols(18, amount=2)
-
-        for i, col_data in enumerate(moved_data):
-            col_idx = 18 + i
-            for row_idx, cell_info in enumerate(col_data, start=1):
-                cell = ws.cell(row=row_idx, column=col_idx)
-                cell.value = cell_info['value']
-                cell._style = cell_info['style']
-                cell.number_format = cell_info['number_format']
-                if cell_info['has_formula']:
-                    cell.value = cell_info['formula']
-
-        # --- Step 2: Copy columns C, D, E, F and insert at N, O, P, Q ---
-        copy_cols = [3, 4, 5, 6]
-        insert_at = 14
-
-        copied_data = []
-        for col_idx in copy_cols:
-            col_data = []
-            for row in ws.iter_rows(min_row=1, max_row=max_row, min_col=col_idx, max_col=col_idx):
-                cell = row[0]
-                col_data.append({
-                    'value': cell.value,
-                    'style': cell._style,
-                    'number_format': cell.number_format,
-                    'has_formula': cell.data_type == 'f',
-                    'formula': cell.value if cell.data_type == 'f' else None
-                })
-            copied_data.append(col_data)
-
-        ws.insert_cols(insert_at, amount=4)
-
-        for i, col_data in enumerate(copied_data):
-            col_idx = insert_at + i
-            for row_idx, cell_info in enumerate(col_data, start=1):
-                cell = ws.cell(row=row_idx, column=col_idx)
-                cell.value = cell_info['value']
-                cell._style = cell_info['style']
-                cell.number_format = cell_info['number_format']
-                if cell_info['has_formula']:
-                    cell.value = cell_info['formula']
-
-        progress_bar.progress(30)
-
-        # --- Step 3: Delete column P and insert empty column with header 'XXXXX' ---
-        ws.delete_cols(16)
-        ws.insert_cols(16)
-        ws.cell(row=1, column=16).value = 'XXXXX'
-
-        # --- Step 4: Insert 5 empty columns after Q ---
-        ws.insert_cols(18, amount=5)
-
-        # --- Step 5: Rename and format headers for R, S, T ---
-        header_map = {18: 'S', 19: 'N', 20: 'D'}
-        header_fill = PatternFill(start_color='00B0F0', end_color='00B0F0', fill_type='solid')
-        header_font = Font(bold=True, color='000000')
-        header_align = Alignment(horizontal='center', vertical='center')
-
-        for col_idx, new_name in header_map.items():
-            cell = ws.cell(row=1, column=col_idx)
-            cell.value = new_name
-            cell.fill = header_fill
-            cell.font = header_font
-            cell.alignment = header_align
-
-        # --- Step 6: Format column V header and columns N, P headers ---
-        v_col = 22
-        v_cell = ws.cell(row=1, column=v_col)
-        v_cell.value = 'Datasheet'
-        v_cell.fill = PatternFill(start_color='00B050', end_color='00B050', fill_type='solid')
-        v_cell.font = Font(bold=True, color='000000')
-        v_cell.alignment = Alignment(horizontal='center', vertical='center')
-
-        for col in [14, 16]:
-            cell = ws.cell(row=1, column=col)
-            cell.fill = PatternFill(start_color='FFC7CE', end_color='FFC7CE', fill_type='solid')
-            cell.font = Font(bold=True, color='9C0006')
-            cell.alignment = Alignment(horizontal='center', vertical='center')
-
-        progress_bar.progress(40)
-
-        # --- Step 7: Concatenate columns for matching rows only ---
-        filter_keywords = ["new", "check updates", "check value"]
-        for row_idx in range(2, ws.max_row + 1):
-            cell_value = ws.cell(row=row_idx, column=8).value
-            if cell_value:
-                cell_str = str(cell_value).lower()
-                if any(keyword in cell_str for keyword in filter_keywords):
-                    n_val = ws.cell(row=row_idx, column=14).value or ""
-                    o_val = ws.cell(row=row_idx, column=15).value or ""
-                    ws.cell(row=row_idx, column=16).value = f"{n_val}{o_val}"
-                    l_val = ws.cell(row=row_idx, column=12).value or ""
-                    m_val = ws.cell(row=row_idx, column=13).value or ""
-                    ws.cell(row=row_idx, column=21).value = f"{l_val}{m_val}"
-
-        # --- Step 8: Process part data file ---
-        status_text.info("Processing part data file...")
-        wb2 = load_workbook(part_data_file)
-        ws2 = wb2.worksheets[0]
-        max_row2 = ws2.max_row
-        ws2.insert_cols(5)
-        ws2.cell(row=1, column=5).value = ''
-        for row_idx in range(2, max_row2 + 1):
-            c_val = ws2.cell(row=row_idx, column=3).value or ""
-            d_val = ws2.cell(row=row_idx, column=4).value or ""
-            ws2.cell(row=row_idx, column=5).value = f"{c_val}{d_val}"
-        wb2.save(part_data_file)
-        progress_bar.progress(50)
-
-        # --- Step 9: Lookup from part data file ---
-        status_text.info("Processing part data lookup...")
-        part_wb = load_workbook(part_data_file, data_only=True)
-        part_ws = part_wb.worksheets[0]
-        lookup_col = 5
-        q_col = 17
-        s_col = 19
-        part_lookup = {}
-        for row in range(2, part_ws.max_row + 1):
-            key = part_ws.cell(row=row, column=lookup_col).value
-            q_val = part_ws.cell(row=row, column=q_col).value
-            s_val = part_ws.cell(row=row, column=s_col).value
-            if key is not None:
-                part_lookup[str(key)] = (q_val, s_val)
-
-        for row_idx in range(2, ws.max_row + 1):
-            h_val = ws.cell(row=row_idx, column=8).value
-            if h_val:
-                h_str = str(h_val).lower()
-                if any(keyword in h_str for keyword in filter_keywords):
-                    lookup_key = ws.cell(row=row_idx, column=21).value
-                    if lookup_key is not None and str(lookup_key) in part_lookup:
-                        q_val, s_val = part_lookup[str(lookup_key)]
-                        if q_val and 'nod' in str(q_val).lower():
-                            ws.cell(row=row_idx, column=22).value = s_val
-                        else:
-                            ws.cell(row=row_idx, column=22).value = q_val
-        progress_bar.progress(70)
-
-        # --- Step 10: COUNTIF-style counts ---
-        filtered_row_indices = []
-        filtered_n = []
-        filtered_p = []
-        filtered_v = []
-        for row_idx in range(2, ws.max_row + 1):
-            h_val = ws.cell(row=row_idx, column=8).value
-            if h_val:
-                h_str = str(h_val).lower()
-                if any(keyword in h_str for keyword in filter_keywords):
-                    filtered_row_indices.append(row_idx)
-                    filtered_n.append(ws.cell(row=row_idx, column=14).value)
-                    filtered_p.append(ws.cell(row=row_idx, column=16).value)
-                    filtered_v.append(ws.cell(row=row_idx, column=22).value)
-
-        for i, row_idx in enumerate(filtered_row_indices):
-            n_val = filtered_n[i]
-            p_val = filtered_p[i]
-            v_val = filtered_v[i]
-            count_n = sum(1 for val in filtered_n if val == n_val and val not in [None, ""])
-            count_p = sum(1 for val in filtered_p if val == p_val and val not in [None, ""])
-            count_v = sum(1 for val in filtered_v if val == v_val and val not in [None, ""])
-            ws.cell(row=row_idx, column=18).value = count_n
-            ws.cell(row=row_idx, column=19).value = count_p
-            ws.cell(row=row_idx, column=20).value = count_v
-
-        progress_bar.progress(85)
-
-        # --- Step 11: Lookup from preset source ---
-        status_text.info("Processing preset lookup and generating output...")
-        lookup_values = []
-        for row_idx in filtered_row_indices:
-            val = ws.cell(row=row_idx, column=16).value
-            if val is not None and val != "":
-                lookup_values.append(str(val))
-
-        matched_rows = preset_df[preset_df.iloc[:, 4].astype(str).isin(lookup_values)]
-
-        # --- Step 12: Final formatting of PIM file ---
-        # Remove column U (21) as it's no longer needed
-        ws.delete_cols(21)
-        
-        # Apply auto filter to all columns
-        max_col = ws.max_column
-        max_row = ws.max_row
-        filter_range = f"A1:{get_column_letter(max_col)}1"
-        ws.auto_filter.ref = filter_range
-        
-        # Add borders to all cells with text and set column widths to fit headers
-        thin_border = Border(
-            left=Side(style='thin'),
-            right=Side(style='thin'),
-            top=Side(style='thin'),
-            bottom=Side(style='thin')
+        def lookup_preset(lookup_values):
+            return lookup_preset_snapshot(preset_dir, lookup_values)
+
+        # Outputs go to disk so large results are never held in memory as a whole
+        sweep_stale_results()
+        results_dir = tempfile.mkdtemp(prefix=RESULTS_DIR_PREFIX)
+        current_date = datetime.now().strftime("%d_%m_%Y")
+        pim_output = os.path.join(results_dir, f"PIM_Processed_{current_date}.xlsx")
+        matched_rows, stats = run_pipeline(
+            BytesIO(pim_file_bytes),
+            BytesIO(part_data_file_bytes),
+            lookup_preset,
+            pim_output,
+            status_callback=status_text.info,
+            progress_callback=progress_bar.progress,
+            mode=engine or MODE_AUTO,
         )
-        
-        # Set column widths based on header text and add borders to cells with content
-        for col_idx in range(1, max_col + 1):
-            header_cell = ws.cell(row=1, column=col_idx)
-            header_value = header_cell.value
-            if header_value:
-                # Set column width to fit header text (with extra padding for filter icon)
-                col_width = len(str(header_value)) + 5
-                ws.column_dimensions[get_column_letter(col_idx)].width = col_width
-            
-            # Add borders to all cells in this column
-            for row_idx in range(1, max_row + 1):
-                cell = ws.cell(row=row_idx, column=col_idx)
-                cell.border = thin_border
-
-        # Save PIM file to bytes
-        pim_output = BytesIO()
-        wb.save(pim_output)
-        pim_output.seek(0)
-
-        # Create preset output file
-        preset_output = None
+        record.update(stats)
+
+        # Create preset output file(s), split when they exceed Excel's row limit
+        preset_started = time.perf_counter()
+        preset_parts = []
         if not matched_rows.empty:
-            preset_output = BytesIO()
-            matched_rows.to_excel(preset_output, index=False)
-            preset_output.seek(0)
-            
-            # Apply formatting
-            preset_output_formatted = BytesIO()
-            wb_out = openpyxl.load_workbook(preset_output)
-            ws_out = wb_out.active
-            
-            green_fill = PatternFill(start_color="00B050", end_color="00B050", fill_type="solid")
-            pink_fill = PatternFill(start_color="FFC7CE", end_color="FFC7CE", fill_type="solid")
-            blue_fill = PatternFill(start_color="00B0F0", end_color="00B0F0", fill_type="solid")
-            black_font = Font(color="000000")
-            red_font = Font(color="9C0006")
-
-            for col_letter in ['D', 'E', 'F']:
-                if ws_out[f'{col_letter}1'].value is not None:
-                    if col_letter == 'D':
-                        ws_out[f'{col_letter}1'].fill = green_fill
-                    elif col_letter == 'E':
-                        ws_out[f'{col_letter}1'].fill = pink_fill
-                    elif col_letter == 'F':
-                        ws_out[f'{col_letter}1'].fill = blue_fill
-
-            ws_out.auto_filter.ref = ws_out.dimensions
-
-            for row in ws_out.iter_rows(min_row=2, max_row=ws_out.max_row):
-                for cell in row:
-                    cell.font = black_font
-
-            ws_out.column_dimensions['D'].width = 37
-            ws_out.column_dimensions['E'].width = 80
-            ws_out.column_dimensions['F'].width = 95
-            
-            wb_out.save(preset_output_formatted)
-            preset_output_formatted.seek(0)
-            preset_output = preset_output_formatted
+            status_text.info("Writing DK Preset file...")
+            preset_parts = write_preset_parts(matched_rows, results_dir, f"DK_Preset_{current_date}.xlsx")
+        record['step_durations']['write_preset'] = round(time.perf_counter() - preset_started, 4)
+
+        # Bundle all outputs into one compressed zip, written chunk by chunk
+        bundle_started = time.perf_counter()
+        status_text.info("Bundling results...")
+        files = [pim_output] + preset_parts
+        zip_path = os.path.join(results_dir, f"PIM_Results_{current_date}.zip")
+        write_zip_bundle(zip_path, files)
+        for path in files:
+            os.remove(path)
+        record['step_durations']['bundle'] = round(time.perf_counter() - bundle_started, 4)
 
         progress_bar.progress(100)
         status_text.success("All steps completed successfully!")
+        st.caption(f"Execution plan: {stats['mode']} engine. {stats['plan_reason']}")
 
-        # Cleanup temp files
-        os.unlink(pim_file)
-        os.unlink(part_data_file)
-
-        return pim_output, preset_output
+        record['status'] = 'ok'
+        return {
+            'dir': results_dir,
+            'zip_path': zip_path,
+            'files': [os.path.basename(path) for path in files],
+            'preset_rows': len(matched_rows),
+            'preset_parts': len(preset_parts),
+        }
 
     except Exception as e:
+        record['status'] = 'error'
+        record['error'] = str(e)
         status_text.error(f"Error: {str(e)}")
-        return None, None
+        if results_dir is not None:
+            shutil.rmtree(results_dir, ignore_errors=True)
+        return None
+
+    finally:
+        if record['status'] is not None:
+            record['duration_seconds'] = round(time.perf_counter() - run_started, 4)
+            save_run_record(record)
 
 
 def main_page():
@@ -363,19 +270,25 @@ def main_page():
     st.markdown("---")
 
     # Initialize session state for results
-    if 'pim_output' not in st.session_state:
-        st.session_state.pim_output = None
-    if 'preset_output' not in st.session_state:
-        st.session_state.preset_output = None
+    if 'results' not in st.session_state:
+        st.session_state.results = None
     if 'process_complete' not in st.session_state:
         st.session_state.process_complete = False
 
     # Check if preset DB exists
-    preset_exists = os.path.exists(PRESET_DB_PATH)
+    preset_exists = preset_db_exists()
     if not preset_exists:
         st.warning("⚠️ No preset database found. Please go to **Settings** page to upload one.")
     else:
-        st.success("✅ Preset database loaded")
+        warmup = start_preset_warmup()
+        index = cached_preset_index(warmup['target']) if warmup['target'] else None
+        if index is not None:
+            key_count = len(index['key_hashes'])
+            st.success(f"✅ Preset database loaded · index ready ({key_count:,} keys)")
+        elif warmup['error']:
+            st.warning(f"⚠️ Preset index warm-up failed ({warmup['error']}); it will be built when you run the process.")
+        else:
+            st.info("⏳ Preset database found · index warming up in the background")
 
     st.subheader("Upload Files")
     
@@ -397,61 +310,96 @@ def main_page():
             key="part_data_file"
         )
 
+    # Pre-flight checks of the uploads from their xlsx metadata, before any full parse
+    preflight_errors = False
+    input_headers = {}
+    if pim_file or part_data_file:
+        from preflight import check_pim_file, check_part_data_file
+
+        expected_headers = expected_input_headers()
+        for column, uploaded_file, check, header_key in [
+            (col1, pim_file, check_pim_file, 'pim_header'),
+            (col2, part_data_file, check_part_data_file, 'part_data_header'),
+        ]:
+            if uploaded_file is None:
+                continue
+            report = preflight_report(uploaded_file, check, expected_headers[header_key])
+            with column:
+                show_preflight_report(report)
+            preflight_errors = preflight_errors or bool(report['errors'])
+            input_headers[header_key] = report['header']
+
     # Clear results when new files are uploaded
     if pim_file is None or part_data_file is None:
         if st.session_state.process_complete:
-            st.session_state.pim_output = None
-            st.session_state.preset_output = None
-            st.session_state.process_complete = False
+            clear_results()
+
+    engine_labels = {
+        "Auto (recommended)": None,
+        "In-memory": 'in_memory',
+        "Columnar": 'columnar',
+        "Streaming": 'streaming',
+    }
+    engine_label = st.selectbox(
+        "⚙️ Processing engine",
+        list(engine_labels),
+        help="Auto picks an engine from the size of the uploads. In-memory keeps the original "
+             "cell styles and extra sheets; Columnar and Streaming keep all values and the tool's "
+             "formatting and handle large reports, Streaming in bounded memory."
+    )
+
+    ignore_preflight = False
+    if preflight_errors:
+        ignore_preflight = st.checkbox("Run anyway despite the pre-flight errors")
 
     st.markdown("---")
 
-    if st.button("🚀 Run Process", type="primary", disabled=not preset_exists):
+    if st.button("🚀 Run Process", type="primary",
+                 disabled=not preset_exists or (preflight_errors and not ignore_preflight)):
         if not pim_file or not part_data_file:
             st.error("Please upload both files before running.")
         else:
             progress_bar = st.progress(0)
             status_text = st.empty()
             
-            pim_output, preset_output = run_full_process(
+            clear_results()
+            results = run_full_process(
                 pim_file.getvalue(),
                 part_data_file.getvalue(),
                 progress_bar,
-                status_text
+                status_text,
+                engine=engine_labels[engine_label],
+                input_headers=input_headers
             )
             
-            if pim_output:
-                st.session_state.pim_output = pim_output.getvalue()
-                st.session_state.preset_output = preset_output.getvalue() if preset_output else None
+            if results:
+                st.session_state.results = results
                 st.session_state.process_complete = True
 
-    # Show download buttons if results exist
-    if st.session_state.process_complete and st.session_state.pim_output:
+    # Offer all results as one zip download
+    results = st.session_state.results
+    if st.session_state.process_complete and results and os.path.exists(results['zip_path']):
         st.markdown("---")
         st.subheader("📥 Download Results")
-        
-        col1, col2 = st.columns(2)
-        
-        current_date = datetime.now().strftime("%d_%m_%Y")
-        
-        with col1:
+
+        with open(results['zip_path'], 'rb') as bundle:
             st.download_button(
-                label="📥 Download Processed PIM File",
-                data=st.session_state.pim_output,
-                file_name=f"PIM_Processed_{current_date}.xlsx",
-                mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"
+                label="📦 Download All Results (.zip)",
+                data=bundle,
+                file_name=os.path.basename(results['zip_path']),
+                mime="application/zip"
             )
-        
-        with col2:
-            if st.session_state.preset_output:
-                st.download_button(
-                    label="📥 Download DK Preset File",
-                    data=st.session_state.preset_output,
-                    file_name=f"DK_Preset_{current_date}.xlsx",
-                    mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"
-                )
-            else:
-                st.info("No matching preset records found.")
+        st.caption(
+            f"{' · '.join(results['files'])} "
+            f"({os.path.getsize(results['zip_path']) / (1024 * 1024):,.1f} MB compressed)"
+        )
+        if results['preset_parts'] > 1:
+            st.info(
+                f"The DK Preset result has {results['preset_rows']:,} rows, more than one Excel sheet "
+                f"can hold, so it was split into {results['preset_parts']} files."
+            )
+        elif not results['preset_parts']:
+            st.info("No matching preset records found.")
 
 
 def settings_page():
@@ -462,22 +410,36 @@ def settings_page():
     st.subheader("Preset Database Management")
 
     # Show current status
-    if os.path.exists(PRESET_DB_PATH):
-        preset_df = load_preset_db()
-        file_stats = os.stat(PRESET_DB_PATH)
-        modified_time = datetime.fromtimestamp(file_stats.st_mtime).strftime("%Y-%m-%d %H:%M:%S")
+    preset_dir = current_snapshot_dir(PRESET_STORE_DIR)
+    if preset_dir is not None:
+        manifest = read_manifest(preset_dir)
+        modified_time = datetime.fromisoformat(manifest['created']).strftime("%Y-%m-%d %H:%M:%S")
         
         st.success(f"✅ Preset database exists")
-        col1, col2, col3 = st.columns(3)
+        col1, col2, col3, col4 = st.columns(4)
         with col1:
-            st.metric("Rows", f"{len(preset_df):,}")
+            st.metric("Rows", f"{manifest['rows']:,}")
         with col2:
-            st.metric("Columns", len(preset_df.columns))
+            st.metric("Columns", len(manifest['columns']))
         with col3:
+            st.metric("Memory", f"{manifest['memory_bytes'] / (1024 * 1024):,.1f} MB")
+        with col4:
             st.metric("Last Updated", modified_time)
+
+        memory_report = st.session_state.get('preset_memory_report')
+        if memory_report:
+            saved_pct = 100 * (1 - memory_report['after_mb'] / memory_report['before_mb']) if memory_report['before_mb'] else 0
+            st.info(
+                f"Last import compacted memory from {memory_report['before_mb']:,.1f} MB "
+                f"to {memory_report['after_mb']:,.1f} MB ({saved_pct:.0f}% smaller)"
+            )
         
         with st.expander("Preview Database (first 10 rows)"):
-            st.dataframe(preset_df.head(10))
+            st.dataframe(load_preset_preview(preset_dir))
+        st.caption(
+            f"Version {os.path.basename(preset_dir)} · "
+            f"stored as {len(manifest['shards'])} of {manifest['num_shards']} key shards"
+        )
     else:
         st.warning("⚠️ No preset database found. Please upload an Excel or PKL file below.")
 
@@ -494,8 +456,19 @@ def settings_page():
     if uploaded_file:
         file_ext = uploaded_file.name.split('.')[-1].lower()
         st.info(f"File selected: {uploaded_file.name} ({file_ext.upper()} format)")
-        
-        if st.button("💾 Save as Preset Database", type="primary"):
+
+        preflight_errors = False
+        if file_ext != 'pkl':
+            from preflight import check_preset_file
+
+            current_columns = manifest['columns'] if preset_dir is not None else None
+            report = preflight_report(uploaded_file, check_preset_file, current_columns)
+            show_preflight_report(report)
+            preflight_errors = bool(report['errors'])
+        ignore_preflight = preflight_errors and st.checkbox("Save anyway despite the pre-flight errors")
+
+        if st.button("💾 Save as Preset Database", type="primary",
+                     disabled=preflight_errors and not ignore_preflight):
             try:
                 with st.spinner("Processing..."):
                     if file_ext == 'pkl':
@@ -504,11 +477,10 @@ def settings_page():
                         st.info("Loaded from PKL file")
                     else:
                         # Load from Excel and convert to PKL (handles multiple sheets)
-                        df_dict = pd.read_excel(uploaded_file, sheet_name=None)
-                        df = pd.concat(df_dict.values(), ignore_index=True)
-                        st.info(f"Converted Excel ({len(df_dict)} sheets) to PKL format")
+                        df, sheet_count = read_preset_excel(uploaded_file)
+                        st.info(f"Converted Excel ({sheet_count} sheets) to PKL format")
                     
-                    save_preset_db(df)
+                    st.session_state.preset_memory_report = save_preset_db(df)
                 st.success(f"✅ Database saved successfully! ({len(df):,} rows)")
                 st.rerun()
             except Exception as e:
@@ -530,11 +502,10 @@ def settings_page():
                             df = pickle.load(f)
                         st.info("Loaded from PKL file")
                     else:
-                        df_dict = pd.read_excel(file_path, sheet_name=None)
-                        df = pd.concat(df_dict.values(), ignore_index=True)
-                        st.info(f"Converted Excel ({len(df_dict)} sheets) to PKL format")
+                        df, sheet_count = read_preset_excel(file_path)
+                        st.info(f"Converted Excel ({sheet_count} sheets) to PKL format")
                     
-                    save_preset_db(df)
+                    st.session_state.preset_memory_report = save_preset_db(df)
                 st.success(f"✅ Database saved successfully! ({len(df):,} rows)")
                 st.rerun()
             except Exception as e:
@@ -544,16 +515,84 @@ def settings_page():
 
     st.markdown("---")
     
+    # Snapshot history and rollback
+    snapshots = list_preset_snapshots(PRESET_STORE_DIR)
+    if snapshots:
+        st.subheader("Preset Versions")
+        current_version = current_snapshot_version(PRESET_STORE_DIR)
+        for version in reversed(snapshots):
+            marker = " ← current" if version == current_version else ""
+            st.text(f"{version}{marker}")
+        previous_version = previous_snapshot_version(PRESET_STORE_DIR)
+        if st.button("↩️ Roll Back to Previous Version", disabled=previous_version is None):
+            rollback_preset_snapshot(PRESET_STORE_DIR)
+            st.success(f"Rolled back to {previous_version}.")
+            st.rerun()
+        st.markdown("---")
+
     # Danger zone
-    if os.path.exists(PRESET_DB_PATH):
+    if preset_db_exists():
         with st.expander("🗑️ Danger Zone"):
-            st.warning("This action cannot be undone!")
+            retention_minutes = DEFAULT_RETENTION_SECONDS // 60
+            st.warning(
+                "Deleting stops all runs until a preset database is uploaded or restored. The deleted database "
+                f"is kept for at least {retention_minutes} minutes; **Roll Back to Previous Version** "
+                "restores it until then."
+            )
             if st.button("Delete Preset Database", type="secondary"):
-                os.remove(PRESET_DB_PATH)
-                st.success("Database deleted.")
+                deactivate_preset_snapshots(PRESET_STORE_DIR)
+                st.success(f"Database deleted. Roll back within {retention_minutes} minutes to restore it.")
                 st.rerun()
 
 
+def history_page():
+    """Run history page with throughput and latency trends."""
+    st.title("📈 Run History")
+    st.markdown("---")
+
+    history = load_run_history()
+    if history.empty:
+        st.info("No runs recorded yet. Runs appear here after the first **Run Process**.")
+        return
+
+    completed = history[history['status'] == 'ok']
+    col1, col2, col3, col4 = st.columns(4)
+    with col1:
+        st.metric("Runs", f"{len(history):,}")
+    with col2:
+        st.metric("Failed", f"{len(history) - len(completed):,}")
+    with col3:
+        st.metric("Median Duration", f"{completed['duration_seconds'].median():,.1f} s" if len(completed) else "-")
+    with col4:
+        st.metric("p95 Duration", f"{completed['duration_seconds'].quantile(0.95):,.1f} s" if len(completed) else "-")
+
+    if len(completed):
+        st.subheader("Throughput (PIM rows per second)")
+        st.line_chart(completed.set_index('started_at')[['rows_per_second']])
+
+        st.subheader("Latency Percentiles")
+        bucket = st.radio("Group by", ["Hour", "Day"], index=1, horizontal=True)
+        period = completed['started_at'].dt.floor('h' if bucket == "Hour" else 'D')
+        latency = completed.groupby(period)['duration_seconds'].quantile([0.5, 0.9, 0.99]).unstack()
+        latency.columns = ['p50', 'p90', 'p99']
+        st.line_chart(latency)
+
+        step_columns = [col for col in completed.columns if col.startswith('step_') and col != 'step_durations']
+        if step_columns:
+            st.subheader("Average Step Duration (s)")
+            step_means = completed[step_columns].mean()
+            step_means.index = [col[len('step_'):] for col in step_columns]
+            st.bar_chart(step_means)
+
+    st.subheader("Recent Runs")
+    recent_columns = [
+        'started_at', 'status', 'mode', 'plan_reason', 'duration_seconds', 'pim_rows', 'filtered_rows',
+        'part_lookup_hit_rate', 'preset_lookup_keys', 'preset_matches',
+        'pim_bytes', 'part_data_bytes', 'preset_version', 'error',
+    ]
+    st.dataframe(history[recent_columns].iloc[::-1].head(50), hide_index=True)
+
+
 # Page navigation
 st.set_page_config(
     page_title="PIM Format Tool",
@@ -561,11 +600,18 @@ st.set_page_config(
     layout="wide"
 )
 
+migrate_legacy_preset_db()
+sweep_stale_results_on_startup()
+# Warm start: load the preset index in the background as soon as the server runs the app
+start_preset_warmup()
+
 # Sidebar navigation
 st.sidebar.title("Navigation")
-page = st.sidebar.radio("Go to", ["🏠 Main", "⚙️ Settings"])
+page = st.sidebar.radio("Go to", ["🏠 Main", "⚙️ Settings", "📈 Run History"])
 
 if page == "🏠 Main":
     main_page()
-else:
+elif page == "⚙️ Settings":
     settings_page()
+else:
+    history_page()
@@ -0,0 +1,49 @@
+import os
+import shutil
+import zipfile
+
+from pim_engine import write_preset_output
+
+# Excel's row limit per sheet; each DK Preset part keeps one row for the header
+EXCEL_MAX_ROWS = 1_048_576
+PRESET_PART_ROWS = EXCEL_MAX_ROWS - 1
+# Bytes copied into the zip per write
+ZIP_CHUNK_BYTES = 1024 * 1024
+
+
+def preset_part_names(file_name, part_count):
+    """Return the file names of the DK Preset parts; file_name itself when there is one part."""
+    if part_count <= 1:
+        return [file_name]
+    stem, ext = os.path.splitext(file_name)
+    return [f"{stem}_part{part}{ext}" for part in range(1, part_count + 1)]
+
+
+def write_preset_parts(matched_rows, output_dir, file_name, part_rows=PRESET_PART_ROWS):
+    """Write the matched preset rows as DK Preset workbooks that each fit one sheet.
+
+    Results up to part_rows rows give a single file_name workbook; larger
+    ones are split into file_name_part1, _part2, ... with a header each.
+    Returns the paths written, in order.
+    """
+    starts = range(0, len(matched_rows), part_rows)
+    paths = []
+    for start, name in zip(starts, preset_part_names(file_name, len(starts))):
+        path = os.path.join(output_dir, name)
+        write_preset_output(matched_rows.iloc[start:start + part_rows], path)
+        paths.append(path)
+    return paths
+
+
+def write_zip_bundle(target, paths):
+    """Write files into one deflate-compressed zip, copying each in chunks.
+
+    target is a path or a writable binary stream; it does not need to be
+    seekable, so the zip can be streamed straight to an HTTP response.
+    Members are stored under their base names.
+    """
+    with zipfile.ZipFile(target, 'w', compression=zipfile.ZIP_DEFLATED) as zf:
+        for path in paths:
+            force_zip64 = os.path.getsize(path) > zipfile.ZIP64_LIMIT
+            with open(path, 'rb') as src, zf.open(os.path.basename(path), 'w', force_zip64=force_zip64) as dst:
+                shutil.copyfileobj(src, dst, ZIP_CHUNK_BYTES)
@@ -0,0 +1,857 @@
+import os
+import pickle
+import re
+import sqlite3
+import tempfile
+import time
+from collections import Counter
+from copy import copy
+from datetime import date, datetime, timedelta
+from decimal import Decimal
+
+from openpyxl import Workbook, load_workbook
+from openpyxl.cell import WriteOnlyCell
+from openpyxl.cell.read_only import EMPTY_CELL
+from openpyxl.styles import PatternFill, Font, Alignment, Border, Side
+from openpyxl.utils import get_column_letter
+
+# Rows whose column H contains one of these are processed (case-insensitive)
+FILTER_KEYWORDS = ["new", "check updates", "check value"]
+
+# Part Data columns (1-based, as in the uploaded file). The key is C & D;
+# the Q and S values of the old in-place layout, which inserted the key as
+# a new column E, are the file's columns P and R.
+PART_KEY_COLS = (3, 4)
+PART_Q_COL = 16
+PART_S_COL = 18
+
+# Pipeline modes: the openpyxl object graph, whole columns of plain values,
+# or bounded-memory row streaming; MODE_AUTO lets plan_pipeline choose
+MODE_IN_MEMORY = 'in_memory'
+MODE_COLUMNAR = 'columnar'
+MODE_STREAMING = 'streaming'
+MODE_AUTO = 'auto'
+# Rows read, spilled and written per batch in streaming mode
+STREAM_BATCH_ROWS = 5000
+# Source columns the final layout refers to (A..S)
+MIN_SOURCE_COLS = 19
+# Largest integer SQLite stores exactly
+SQLITE_MAX_INT = 2 ** 63 - 1
+# Number formats DataFrame.to_excel gives dates in the DK Preset output
+PRESET_DATETIME_FORMAT = "YYYY-MM-DD HH:MM:SS"
+PRESET_DATE_FORMAT = "YYYY-MM-DD"
+
+# Planner: approximate peak memory per PIM source cell of the engines that
+# hold the whole report, and per Part Data row held by the part lookup
+PLAN_BYTES_PER_CELL = {MODE_IN_MEMORY: 800, MODE_COLUMNAR: 150}
+PLAN_BYTES_PER_PART_ROW = 400
+# Memory budget of a run, overridable through the environment variable
+MEMORY_BUDGET_ENV = 'PIM_MEMORY_BUDGET_MB'
+DEFAULT_MEMORY_BUDGET_MB = 1024
+
+
+def is_filtered_row(h_val):
+    """Return True if a PIM row's column H value marks it for processing."""
+    if not h_val:
+        return False
+    h_str = str(h_val).lower()
+    return any(keyword in h_str for keyword in FILTER_KEYWORDS)
+
+
+def build_part_lookup(part_data_file):
+    """Read the Part Data file into a dict of C&D key -> (Q, S) values.
+
+    The file is read in read-only mode and never modified. Its dimension tag
+    is ignored, as some writers leave it stale (e.g. "A1").
+    """
+    wb = load_workbook(part_data_file, read_only=True, data_only=True)
+    try:
+        ws = wb.worksheets[0]
+        ws.reset_dimensions()
+        width = max(PART_KEY_COLS + (PART_Q_COL, PART_S_COL))
+        part_lookup = {}
+        for row in ws.iter_rows(min_row=2, values_only=True):
+            row = tuple(row) + (None,) * (width - len(row))
+            c_val = row[PART_KEY_COLS[0] - 1] or ""
+            d_val = row[PART_KEY_COLS[1] - 1] or ""
+            key = f"{c_val}{d_val}"
+            # Empty keys were never written back by the old in-place step
+            if key:
+                part_lookup[key] = (row[PART_Q_COL - 1], row[PART_S_COL - 1])
+        return part_lookup
+    finally:
+        wb.close()
+
+
+def datasheet_value(q_val, s_val):
+    """Pick the Datasheet value: S when Q mentions 'nod', otherwise Q."""
+    if q_val and 'nod' in str(q_val).lower():
+        return s_val
+    return q_val
+
+
+def _copy_columns(ws, col_indices, max_row):
+    """Capture the values and styles of whole columns."""
+    copied_data = []
+    for col_idx in col_indices:
+        col_data = []
+        for row in ws.iter_rows(min_row=1, max_row=max_row, min_col=col_idx, max_col=col_idx):
+            cell = row[0]
+            col_data.append({
+                'value': cell.value,
+                'style': cell._style,
+                'number_format': cell.number_format,
+            })
+        copied_data.append(col_data)
+    return copied_data
+
+
+def _paste_columns(ws, copied_data, first_col):
+    """Write columns captured by _copy_columns starting at first_col."""
+    for i, col_data in enumerate(copied_data):
+        col_idx = first_col + i
+        for row_idx, cell_info in enumerate(col_data, start=1):
+            cell = ws.cell(row=row_idx, column=col_idx)
+            cell.value = cell_info['value']
+            cell._style = cell_info['style']
+            cell.number_format = cell_info['number_format']
+
+
+def _step_timer(stats):
+    """Return a function recording the time since its previous call as a step."""
+    step_started = time.perf_counter()
+
+    def end_step(name):
+        nonlocal step_started
+        now = time.perf_counter()
+        stats['step_durations'][name] = round(now - step_started, 4)
+        step_started = now
+
+    return end_step
+
+
+def memory_budget_mb():
+    """Return the memory budget of a run in MB, from the environment if set."""
+    try:
+        return float(os.environ[MEMORY_BUDGET_ENV])
+    except (KeyError, ValueError):
+        return DEFAULT_MEMORY_BUDGET_MB
+
+
+def plan_pipeline(pim_file, part_data_file, budget_mb=None):
+    """Pick the engine for a run from the inputs' xlsx metadata.
+
+    Only the zip directories and sheet dimension tags are read. Reports whose
+    estimated peak memory fits the budget use MODE_IN_MEMORY, which keeps
+    every cell style and the other sheets; larger ones use MODE_COLUMNAR
+    when its estimate fits and MODE_STREAMING otherwise.
+
+    Returns a dict with the chosen 'mode', the 'reason' for it and the
+    'estimates' it was based on.
+    """
+    from xlsx_inspect import sheet_dimension
+
+    budget_mb = budget_mb or memory_budget_mb()
+    try:
+        pim = sheet_dimension(pim_file)
+        part = sheet_dimension(part_data_file)
+    except Exception as e:
+        # The engines report unreadable files with a clearer error
+        return {
+            'mode': MODE_IN_MEMORY,
+            'reason': f"Input metadata could not be read ({e}); using the in-memory engine",
+            'estimates': {'budget_mb': budget_mb},
+        }
+
+    part_mb = part['rows'] * PLAN_BYTES_PER_PART_ROW / 1024 ** 2
+    estimated_mb = {
+        engine: round(pim['cells'] * bytes_per_cell / 1024 ** 2 + part_mb, 1)
+        for engine, bytes_per_cell in PLAN_BYTES_PER_CELL.items()
+    }
+    estimates = {
+        'pim_bytes': pim['bytes'],
+        'pim_rows': pim['rows'],
+        'pim_cols': pim['cols'],
+        'pim_cells': pim['cells'],
+        'part_data_bytes': part['bytes'],
+        'part_data_rows': part['rows'],
+        'estimated_mb': estimated_mb,
+        'budget_mb': budget_mb,
+    }
+    size = f"{pim['rows']:,} rows x {pim['cols']} columns"
+
+    if estimated_mb[MODE_IN_MEMORY] <= budget_mb:
+        mode = MODE_IN_MEMORY
+        reason = (f"{size}: in-memory engine (~{estimated_mb[MODE_IN_MEMORY]:,} MB) fits the "
+                  f"{budget_mb:,.0f} MB budget and keeps every cell style")
+    elif estimated_mb[MODE_COLUMNAR] <= budget_mb:
+        mode = MODE_COLUMNAR
+        reason = (f"{size}: columnar engine (~{estimated_mb[MODE_COLUMNAR]:,} MB) fits the "
+                  f"{budget_mb:,.0f} MB budget; in-memory would need ~{estimated_mb[MODE_IN_MEMORY]:,} MB")
+    else:
+        mode = MODE_STREAMING
+        reason = (f"{size}: columnar engine would need ~{estimated_mb[MODE_COLUMNAR]:,} MB, over the "
+                  f"{budget_mb:,.0f} MB budget; streaming in bounded memory")
+    return {'mode': mode, 'reason': reason, 'estimates': estimates}
+
+
+def run_pipeline(pim_file, part_data_file, lookup_preset, pim_output,
+                 status_callback=None, progress_callback=None, mode=MODE_IN_MEMORY,
+                 budget_mb=None):
+    """Run Steps 1-12 on a PIM report and write the processed workbook once.
+
+    pim_file and part_data_file are paths or binary file objects; neither is
+    modified. lookup_preset(keys) returns the preset rows for a list of keys.
+    The processed PIM workbook is saved to pim_output (a path or file object).
+
+    mode selects MODE_IN_MEMORY (openpyxl object graph, keeps every cell
+    style and the other sheets), MODE_COLUMNAR (plain column values with
+    vectorized steps) or MODE_STREAMING (bounded memory); the latter two
+    write the values plus the tool's own header formatting and borders, first
+    sheet only. MODE_AUTO lets plan_pipeline choose within budget_mb.
+
+    Returns (matched_rows, stats) where stats holds row counts, the engine
+    used, the reason it was chosen and the duration of each step in seconds.
+    """
+    status_callback = status_callback or (lambda message: None)
+    progress_callback = progress_callback or (lambda value: None)
+    plan_started = time.perf_counter()
+    if mode == MODE_AUTO:
+        plan = plan_pipeline(pim_file, part_data_file, budget_mb)
+        status_callback(f"Execution plan: {plan['mode']} engine. {plan['reason']}")
+    else:
+        plan = {'mode': mode, 'reason': "Engine selected explicitly", 'estimates': {}}
+    plan_seconds = round(time.perf_counter() - plan_started, 4)
+
+    runs = {
+        MODE_IN_MEMORY: _run_in_memory,
+        MODE_COLUMNAR: _run_columnar,
+        MODE_STREAMING: _run_streaming,
+    }
+    if plan['mode'] not in runs:
+        raise ValueError(f"Unknown pipeline mode: {mode}")
+    matched_rows, stats = runs[plan['mode']](pim_file, part_data_file, lookup_preset, pim_output,
+                                             status_callback, progress_callback)
+    stats['mode'] = plan['mode']
+    stats['plan_reason'] = plan['reason']
+    stats['plan_estimates'] = plan['estimates']
+    stats['step_durations'] = {'plan': plan_seconds, **stats['step_durations']}
+    return matched_rows, stats
+
+
+def _run_in_memory(pim_file, part_data_file, lookup_preset, pim_output,
+                   status_callback, progress_callback):
+    """Run the pipeline on the full openpyxl object graph of the PIM report."""
+    stats = {'step_durations': {}}
+    end_step = _step_timer(stats)
+
+    # Step 1: Load PIM file
+    status_callback("Loading PIM file...")
+    progress_callback(10)
+    wb = load_workbook(pim_file)
+    ws = wb.worksheets[0]
+    max_row = ws.max_row
+    stats['pim_rows'] = max_row - 1
+    end_step('load_pim')
+
+    # --- Step 1: Move columns N and O to R and S ---
+    moved_data = _copy_columns(ws, [14, 15], max_row)  # N, O
+    ws.delete_cols(15)
+    ws.delete_cols(14)
+    ws.insert_cols(18, amount=2)
+    _paste_columns(ws, moved_data, 18)
+
+    # --- Step 2: Copy columns C, D, E, F and insert at N, O, P, Q ---
+    copied_data = _copy_columns(ws, [3, 4, 5, 6], max_row)
+    ws.insert_cols(14, amount=4)
+    _paste_columns(ws, copied_data, 14)
+    progress_callback(30)
+
+    # --- Step 3: Delete column P and insert empty column with header 'XXXXX' ---
+    ws.delete_cols(16)
+    ws.insert_cols(16)
+    ws.cell(row=1, column=16).value = 'XXXXX'
+
+    # --- Step 4: Insert 5 empty columns after Q ---
+    ws.insert_cols(18, amount=5)
+
+    # --- Step 5: Rename and format headers for R, S, T ---
+    header_map = {18: 'S', 19: 'N', 20: 'D'}
+    header_fill = PatternFill(start_color='00B0F0', end_color='00B0F0', fill_type='solid')
+    header_font = Font(bold=True, color='000000')
+    header_align = Alignment(horizontal='center', vertical='center')
+
+    for col_idx, new_name in header_map.items():
+        cell = ws.cell(row=1, column=col_idx)
+        cell.value = new_name
+        cell.fill = header_fill
+        cell.font = header_font
+        cell.alignment = header_align
+
+    # --- Step 6: Format column V header and columns N, P headers ---
+    v_cell = ws.cell(row=1, column=22)
+    v_cell.value = 'Datasheet'
+    v_cell.fill = PatternFill(start_color='00B050', end_color='00B050', fill_type='solid')
+    v_cell.font = Font(bold=True, color='000000')
+    v_cell.alignment = Alignment(horizontal='center', vertical='center')
+
+    for col in [14, 16]:
+        cell = ws.cell(row=1, column=col)
+        cell.fill = PatternFill(start_color='FFC7CE', end_color='FFC7CE', fill_type='solid')
+        cell.font = Font(bold=True, color='9C0006')
+        cell.alignment = Alignment(horizontal='center', vertical='center')
+
+    progress_callback(40)
+    end_step('column_layout')
+
+    # --- Step 7: Concatenate columns for matching rows only ---
+    # Rows are classified once here and reused by Steps 9-11
+    filtered_row_indices = [
+        row_idx for row_idx in range(2, ws.max_row + 1)
+        if is_filtered_row(ws.cell(row=row_idx, column=8).value)
+    ]
+    for row_idx in filtered_row_indices:
+        n_val = ws.cell(row=row_idx, column=14).value or ""
+        o_val = ws.cell(row=row_idx, column=15).value or ""
+        ws.cell(row=row_idx, column=16).value = f"{n_val}{o_val}"
+        l_val = ws.cell(row=row_idx, column=12).value or ""
+        m_val = ws.cell(row=row_idx, column=13).value or ""
+        ws.cell(row=row_idx, column=21).value = f"{l_val}{m_val}"
+    end_step('concatenate')
+
+    # --- Step 8: Build the part data key (C & D) without touching the file ---
+    status_callback("Processing part data file...")
+    part_lookup = build_part_lookup(part_data_file)
+    progress_callback(50)
+
+    # --- Step 9: Lookup from part data file ---
+    status_callback("Processing part data lookup...")
+    part_lookup_hits = 0
+    for row_idx in filtered_row_indices:
+        lookup_key = ws.cell(row=row_idx, column=21).value
+        if lookup_key is not None and str(lookup_key) in part_lookup:
+            part_lookup_hits += 1
+            ws.cell(row=row_idx, column=22).value = datasheet_value(*part_lookup[str(lookup_key)])
+    stats['part_lookup_hits'] = part_lookup_hits
+    progress_callback(70)
+    end_step('part_data_lookup')
+
+    # --- Step 10: COUNTIF-style counts among filtered rows ---
+    filtered_n = [ws.cell(row=row_idx, column=14).value for row_idx in filtered_row_indices]
+    filtered_p = [ws.cell(row=row_idx, column=16).value for row_idx in filtered_row_indices]
+    filtered_v = [ws.cell(row=row_idx, column=22).value for row_idx in filtered_row_indices]
+    count_n = Counter(val for val in filtered_n if val not in [None, ""])
+    count_p = Counter(val for val in filtered_p if val not in [None, ""])
+    count_v = Counter(val for val in filtered_v if val not in [None, ""])
+
+    for i, row_idx in enumerate(filtered_row_indices):
+        ws.cell(row=row_idx, column=18).value = count_n[filtered_n[i]] if filtered_n[i] not in [None, ""] else 0
+        ws.cell(row=row_idx, column=19).value = count_p[filtered_p[i]] if filtered_p[i] not in [None, ""] else 0
+        ws.cell(row=row_idx, column=20).value = count_v[filtered_v[i]] if filtered_v[i] not in [None, ""] else 0
+    stats['filtered_rows'] = len(filtered_row_indices)
+    progress_callback(85)
+    end_step('counts')
+
+    # --- Step 11: Lookup from preset source ---
+    status_callback("Processing preset lookup and generating output...")
+    lookup_values = [str(val) for val in filtered_p if val is not None and val != ""]
+    matched_rows = lookup_preset(lookup_values)
+    stats['preset_lookup_keys'] = len(set(lookup_values))
+    stats['preset_matches'] = len(matched_rows)
+    end_step('preset_lookup')
+
+    # --- Step 12: Final formatting of PIM file ---
+    format_pim_sheet(ws)
+    wb.save(pim_output)
+    end_step('write_pim')
+    return matched_rows, stats
+
+
+def remap_row(values, p_val=None, counts=(None, None, None), datasheet=None):
+    """Rearrange one source row into the final PIM column layout of Steps 1-12.
+
+    The result is A-M, copies of C and D, P (the C&D key), F, the R/S/T
+    counts, the Datasheet value, the source's P-S, N and O, then T onwards.
+    """
+    v = list(values) + [None] * (MIN_SOURCE_COLS - len(values))
+    return v[0:13] + [v[2], v[3], p_val, v[5]] + list(counts) + [datasheet] + v[15:19] + [v[13], v[14]] + v[19:]
+
+
+def _count_key(val):
+    """Normalise a value for SQLite so equal Python values compare equal."""
+    if val is None or val == "":
+        return None
+    if isinstance(val, bool):
+        return int(val)
+    if isinstance(val, float) and val.is_integer():
+        val = int(val)
+    if isinstance(val, int):
+        return val if abs(val) <= SQLITE_MAX_INT else f"int:{val}"
+    if isinstance(val, (float, str)):
+        return val
+    return f"{type(val).__name__}:{val!r}"
+
+
+def _used_columns(cells):
+    """Return how many leading columns of a read-only row hold real cells."""
+    for col_idx in range(len(cells), 0, -1):
+        if cells[col_idx - 1] is not EMPTY_CELL:
+            return col_idx
+    return 0
+
+
+def _write_only_cell(ws, value, style):
+    """Create a write-only cell that shares a pre-registered style array.
+
+    Copying the style array avoids re-registering the border for every cell;
+    the value is set afterwards so dates still get their number format.
+    """
+    cell = WriteOnlyCell(ws)
+    cell._style = copy(style)
+    cell.value = value
+    return cell
+
+
+def _truthy(col):
+    """Vectorized bool() of an object column: None, '', 0 and False are falsy."""
+    return col.notna() & ~col.isin(["", 0])
+
+
+def _as_text(col):
+    """Return str() of each value of an object column, with falsy values as ''."""
+    return col.where(_truthy(col), "").astype("string[python]")
+
+
+def _iter_pim_rows(ws, sheet):
+    """Yield (row_idx, values) for the data rows of a read-only PIM sheet.
+
+    values hold the row's cells, padded to at least the source columns the
+    final layout refers to. The sheet's dimension tag is ignored, as some
+    writers leave it stale (e.g. "A1"). sheet receives the 'title' and
+    'header' and, as rows are read, the widest row's column count 'cols' and
+    the 'source_cols' and 'last_used_row' that hold real cells; these keep
+    the output identical to the in-memory layout.
+    """
+    ws.reset_dimensions()
+    rows = ws.iter_rows()
+    header_cells = next(rows, ())
+    sheet.update(
+        title=ws.title,
+        header=[cell.value for cell in header_cells],
+        cols=max(len(header_cells), MIN_SOURCE_COLS),
+        source_cols=_used_columns(header_cells),
+        last_used_row=0,
+    )
+    for row_idx, cells in enumerate(rows, start=1):
+        used_cols = _used_columns(cells)
+        if used_cols:
+            sheet['last_used_row'] = row_idx
+            sheet['source_cols'] = max(sheet['source_cols'], used_cols)
+        values = [cell.value for cell in cells]
+        values += [None] * (MIN_SOURCE_COLS - len(values))
+        sheet['cols'] = max(sheet['cols'], len(values))
+        yield row_idx, values
+
+
+def _expected_data_rows(pim_file):
+    """Estimate the data rows of a PIM sheet for progress reports, at least 1."""
+    from xlsx_inspect import sheet_dimension
+
+    try:
+        return max(sheet_dimension(pim_file)['rows'] - 1, 1)
+    except Exception:
+        # The reader reports unreadable files with a clearer error
+        return 1
+
+
+def _pad_row(values, width):
+    """Return values cut or padded with None to width columns."""
+    return list(values[:width]) + [None] * (width - len(values))
+
+
+def _run_columnar(pim_file, part_data_file, lookup_preset, pim_output,
+                  status_callback, progress_callback):
+    """Run the pipeline on whole columns of plain cell values.
+
+    The PIM sheet is read once in read-only mode into a DataFrame of Python
+    objects instead of the openpyxl cell graph. The row filter and the
+    concatenations are column operations over the whole sheet, Step 10 counts
+    the filtered columns with Counter, and the rows are written through a
+    write-only workbook.
+    """
+    import pandas as pd
+
+    stats = {'step_durations': {}}
+    end_step = _step_timer(stats)
+
+    # Step 1: Load PIM values
+    status_callback("Loading PIM file...")
+    progress_callback(10)
+    wb = load_workbook(pim_file, read_only=True)
+    sheet = {}
+    try:
+        data = [values for row_idx, values in _iter_pim_rows(wb.worksheets[0], sheet)]
+    finally:
+        wb.close()
+    # Trailing rows without any cell are not part of the sheet
+    del data[sheet['last_used_row']:]
+    data = [_pad_row(values, sheet['cols']) for values in data]
+    df = pd.DataFrame(data, columns=range(sheet['cols']), dtype=object)
+    del data
+    stats['pim_rows'] = len(df)
+    progress_callback(40)
+    end_step('load_pim')
+
+    # --- Step 7: Concatenate columns for matching rows only ---
+    h_text = _as_text(df[7]).str.lower()
+    mask = h_text.str.contains("|".join(re.escape(keyword) for keyword in FILTER_KEYWORDS), regex=True)
+    filtered = df[mask.to_numpy(dtype=bool)]
+    p_vals = (_as_text(filtered[2]) + _as_text(filtered[3])).tolist()
+    u_keys = (_as_text(filtered[11]) + _as_text(filtered[12])).tolist()
+    stats['filtered_rows'] = len(filtered)
+    end_step('concatenate')
+
+    # --- Step 8: Build the part data key (C & D) without touching the file ---
+    status_callback("Processing part data file...")
+    part_lookup = build_part_lookup(part_data_file)
+    progress_callback(50)
+
+    # --- Step 9: Lookup from part data file ---
+    status_callback("Processing part data lookup...")
+    part_hits = [part_lookup.get(key) for key in u_keys]
+    datasheets = [datasheet_value(*hit) if hit is not None else None for hit in part_hits]
+    stats['part_lookup_hits'] = sum(hit is not None for hit in part_hits)
+    progress_callback(70)
+    end_step('part_data_lookup')
+
+    # --- Step 10: COUNTIF-style counts among filtered rows ---
+    filtered_n = filtered[2].tolist()
+    counts = []
+    for column in (filtered_n, p_vals, datasheets):
+        counter = Counter(val for val in column if val not in [None, ""])
+        counts.append([counter[val] if val not in [None, ""] else 0 for val in column])
+    processed = dict(zip(filtered.index, zip(p_vals, zip(*counts), datasheets)))
+    progress_callback(80)
+    end_step('counts')
+
+    # --- Step 11: Lookup from preset source ---
+    status_callback("Processing preset lookup and generating output...")
+    lookup_values = [val for val in p_vals if val != ""]
+    matched_rows = lookup_preset(lookup_values)
+    stats['preset_lookup_keys'] = len(set(lookup_values))
+    stats['preset_matches'] = len(matched_rows)
+    progress_callback(85)
+    end_step('preset_lookup')
+
+    # --- Step 12: Write the formatted rows into a write-only workbook ---
+    def processed_rows():
+        unfiltered = (None, (None, None, None), None)
+        for row_idx, values in enumerate(df.itertuples(index=False, name=None)):
+            p_val, row_counts, datasheet = processed.get(row_idx, unfiltered)
+            yield values, p_val, row_counts, datasheet
+
+    _write_pim_rows(
+        processed_rows(), sheet, pim_output,
+        lambda done: progress_callback(85 + int(10 * min(done / max(len(df), 1), 1)))
+    )
+    end_step('write_pim')
+    return matched_rows, stats
+
+
+def _run_streaming(pim_file, part_data_file, lookup_preset, pim_output,
+                   status_callback, progress_callback, batch_rows=STREAM_BATCH_ROWS):
+    """Run the pipeline in row batches with memory bounded by the batch size.
+
+    Pass 1 reads the PIM sheet in read-only mode, applies the column layout,
+    concatenations and part data lookup per row and spills the rows and
+    Step 10 keys to a temporary SQLite file. Step 10 is then an aggregate
+    over the spilled keys, and pass 2 streams the rows with their counts
+    into a write-only workbook.
+    """
+    stats = {'step_durations': {}}
+    end_step = _step_timer(stats)
+
+    # --- Step 8: Build the part data key (C & D) without touching the file ---
+    status_callback("Processing part data file...")
+    progress_callback(10)
+    part_lookup = build_part_lookup(part_data_file)
+    end_step('part_data_load')
+
+    with tempfile.TemporaryDirectory() as spill_dir:
+        conn = sqlite3.connect(os.path.join(spill_dir, 'spill.db'))
+        try:
+            conn.execute("PRAGMA journal_mode=OFF")
+            conn.execute("PRAGMA synchronous=OFF")
+            conn.execute("CREATE TABLE rows (idx INTEGER PRIMARY KEY, filtered INTEGER, n, p, v, payload BLOB)")
+
+            # --- Steps 1-9 per row batch ---
+            status_callback("Loading PIM file...")
+            expected_rows = _expected_data_rows(pim_file)
+            wb = load_workbook(pim_file, read_only=True)
+            sheet = {}
+            try:
+                status_callback("Processing PIM rows and part data lookup...")
+                filtered_rows = part_lookup_hits = 0
+                batch = []
+                for row_idx, values in _iter_pim_rows(wb.worksheets[0], sheet):
+                    p_val = datasheet = None
+                    filtered = is_filtered_row(values[7])
+                    if filtered:
+                        filtered_rows += 1
+                        p_val = f"{values[2] or ''}{values[3] or ''}"
+                        u_key = f"{values[11] or ''}{values[12] or ''}"
+                        if u_key in part_lookup:
+                            part_lookup_hits += 1
+                            datasheet = datasheet_value(*part_lookup[u_key])
+                    batch.append((
+                        row_idx, int(filtered),
+                        _count_key(values[2]) if filtered else None,
+                        _count_key(p_val), _count_key(datasheet),
+                        pickle.dumps((values, p_val, datasheet), pickle.HIGHEST_PROTOCOL),
+                    ))
+                    if len(batch) >= batch_rows:
+                        conn.executemany("INSERT INTO rows VALUES (?, ?, ?, ?, ?, ?)", batch)
+                        batch = []
+                        progress_callback(10 + int(60 * min(row_idx / expected_rows, 1)))
+                conn.executemany("INSERT INTO rows VALUES (?, ?, ?, ?, ?, ?)", batch)
+                # Trailing rows without any cell are not part of the sheet
+                conn.execute("DELETE FROM rows WHERE idx > ?", (sheet['last_used_row'],))
+                conn.commit()
+            finally:
+                wb.close()
+            last_used_row = sheet['last_used_row']
+            stats['pim_rows'] = last_used_row
+            stats['filtered_rows'] = filtered_rows
+            stats['part_lookup_hits'] = part_lookup_hits
+            progress_callback(70)
+            end_step('transform')
+
+            # --- Step 10: COUNTIF-style counts as an aggregate over the spilled keys ---
+            for col in ['n', 'p', 'v']:
+                conn.execute(
+                    f"CREATE TABLE counts_{col} AS SELECT {col} AS k, COUNT(*) AS c "
+                    f"FROM rows WHERE filtered AND {col} IS NOT NULL GROUP BY {col}"
+                )
+                conn.execute(f"CREATE INDEX counts_{col}_k ON counts_{col} (k)")
+            progress_callback(80)
+            end_step('counts')
+
+            # --- Step 11: Lookup from preset source ---
+            status_callback("Processing preset lookup and generating output...")
+            lookup_values = [row[0] for row in conn.execute("SELECT DISTINCT p FROM rows WHERE filtered AND p IS NOT NULL")]
+            matched_rows = lookup_preset(lookup_values)
+            stats['preset_lookup_keys'] = len(lookup_values)
+            stats['preset_matches'] = len(matched_rows)
+            progress_callback(85)
+            end_step('preset_lookup')
+
+            # --- Step 12: Stream the formatted rows into a write-only workbook ---
+            _write_pim_rows(
+                _spilled_rows(conn, batch_rows), sheet, pim_output,
+                lambda done: progress_callback(85 + int(10 * min(done / max(last_used_row, 1), 1))),
+                batch_rows
+            )
+            end_step('write_pim')
+        finally:
+            conn.close()
+    return matched_rows, stats
+
+
+def _spilled_rows(conn, batch_rows):
+    """Yield the spilled rows in sheet order with their Step 10 counts."""
+    cursor = conn.execute(
+        "SELECT r.payload, r.filtered, cn.c, cp.c, cv.c FROM rows r "
+        "LEFT JOIN counts_n cn ON cn.k = r.n "
+        "LEFT JOIN counts_p cp ON cp.k = r.p "
+        "LEFT JOIN counts_v cv ON cv.k = r.v "
+        "ORDER BY r.idx"
+    )
+    while True:
+        batch = cursor.fetchmany(batch_rows)
+        if not batch:
+            return
+        for payload, filtered, count_n, count_p, count_v in batch:
+            values, p_val, datasheet = pickle.loads(payload)
+            counts = (count_n or 0, count_p or 0, count_v or 0) if filtered else (None, None, None)
+            yield values, p_val, counts, datasheet
+
+
+def _write_pim_rows(rows, sheet, pim_output, progress, batch_rows=STREAM_BATCH_ROWS):
+    """Write (values, p_val, counts, datasheet) rows as the processed PIM sheet.
+
+    The write-only workbook holds one row at a time; sheet is the header
+    information gathered by _iter_pim_rows.
+    """
+    thin_border = Border(
+        left=Side(style='thin'),
+        right=Side(style='thin'),
+        top=Side(style='thin'),
+        bottom=Side(style='thin')
+    )
+    header_styles = {
+        14: (PatternFill(start_color='FFC7CE', end_color='FFC7CE', fill_type='solid'), Font(bold=True, color='9C0006')),
+        16: (PatternFill(start_color='FFC7CE', end_color='FFC7CE', fill_type='solid'), Font(bold=True, color='9C0006')),
+        18: (PatternFill(start_color='00B0F0', end_color='00B0F0', fill_type='solid'), Font(bold=True, color='000000')),
+        19: (PatternFill(start_color='00B0F0', end_color='00B0F0', fill_type='solid'), Font(bold=True, color='000000')),
+        20: (PatternFill(start_color='00B0F0', end_color='00B0F0', fill_type='solid'), Font(bold=True, color='000000')),
+        21: (PatternFill(start_color='00B050', end_color='00B050', fill_type='solid'), Font(bold=True, color='000000')),
+    }
+    header_align = Alignment(horizontal='center', vertical='center')
+
+    source_cols = sheet['source_cols']
+    header_row = remap_row(sheet['header'][:source_cols], 'XXXXX', ('S', 'N', 'D'), 'Datasheet')
+    width = len(remap_row([None] * source_cols))
+    header_row += [None] * (width - len(header_row))
+
+    wb_out = Workbook(write_only=True)
+    ws_out = wb_out.create_sheet(title=sheet['title'])
+    for col_idx, header_value in enumerate(header_row, start=1):
+        if header_value:
+            # Extra padding for the filter icon
+            ws_out.column_dimensions[get_column_letter(col_idx)].width = len(str(header_value)) + 5
+    ws_out.auto_filter.ref = f"A1:{get_column_letter(width)}1"
+
+    bordered = WriteOnlyCell(ws_out)
+    bordered.border = thin_border
+    border_style = bordered._style
+
+    header_cells = []
+    for col_idx, value in enumerate(header_row, start=1):
+        cell = _write_only_cell(ws_out, value, border_style)
+        if col_idx in header_styles:
+            cell.fill, cell.font = header_styles[col_idx]
+            cell.alignment = header_align
+        header_cells.append(cell)
+    ws_out.append(header_cells)
+
+    row_width = max(source_cols, MIN_SOURCE_COLS)
+    written = 0
+    for values, p_val, counts, datasheet in rows:
+        ws_out.append([
+            _write_only_cell(ws_out, value, border_style)
+            for value in remap_row(_pad_row(values, row_width), p_val, counts, datasheet)
+        ])
+        written += 1
+        if written % batch_rows == 0:
+            progress(written)
+    progress(written)
+    wb_out.save(pim_output)
+
+
+def format_pim_sheet(ws):
+    """Drop the helper column U, add the header filter, borders and widths."""
+    # Remove column U (21) as it's no longer needed
+    ws.delete_cols(21)
+
+    # Apply auto filter to all columns
+    max_col = ws.max_column
+    max_row = ws.max_row
+    ws.auto_filter.ref = f"A1:{get_column_letter(max_col)}1"
+
+    thin_border = Border(
+        left=Side(style='thin'),
+        right=Side(style='thin'),
+        top=Side(style='thin'),
+        bottom=Side(style='thin')
+    )
+
+    # Set column widths based on header text and add borders to all cells
+    for col_idx in range(1, max_col + 1):
+        header_value = ws.cell(row=1, column=col_idx).value
+        if header_value:
+            # Extra padding for the filter icon
+            ws.column_dimensions[get_column_letter(col_idx)].width = len(str(header_value)) + 5
+        for row_idx in range(1, max_row + 1):
+            ws.cell(row=row_idx, column=col_idx).border = thin_border
+
+
+def _preset_cell_value(val):
+    """Return (value, number_format) of a preset value as DataFrame.to_excel writes it.
+
+    Missing values become empty cells, infinities the text 'inf', numpy
+    scalars Python values and dates get pandas' default formats.
+    """
+    import numpy as np
+    import pandas as pd
+
+    if isinstance(val, str):
+        return val, None
+    if val is None or val is pd.NaT:
+        return None, None
+    if isinstance(val, (bool, np.bool_)):
+        return bool(val), None
+    if isinstance(val, (int, np.integer)):
+        return int(val), None
+    if isinstance(val, (float, np.floating)):
+        if val != val:
+            return None, None
+        if val in (float('inf'), float('-inf')):
+            return ('inf' if val > 0 else '-inf'), None
+        return float(val), None
+    if pd.api.types.is_scalar(val) and pd.isna(val):
+        return None, None
+    if isinstance(val, datetime):
+        if val.tzinfo is not None:
+            raise ValueError("Excel does not support datetimes with timezones")
+        return val, PRESET_DATETIME_FORMAT
+    if isinstance(val, date):
+        return val, PRESET_DATE_FORMAT
+    if isinstance(val, timedelta):
+        return val.total_seconds() / 86400, "0"
+    if isinstance(val, Decimal):
+        return val, None
+    return str(val), None
+
+
+def write_preset_output(matched_rows, target, batch_rows=STREAM_BATCH_ROWS):
+    """Write the matched preset rows as the formatted DK Preset workbook.
+
+    Rows are streamed through a write-only workbook in batches, so memory
+    does not grow with the row count; values are written as
+    DataFrame.to_excel writes them.
+    """
+    green_fill = PatternFill(start_color="00B050", end_color="00B050", fill_type="solid")
+    pink_fill = PatternFill(start_color="FFC7CE", end_color="FFC7CE", fill_type="solid")
+    blue_fill = PatternFill(start_color="00B0F0", end_color="00B0F0", fill_type="solid")
+    header_fills = {4: green_fill, 5: pink_fill, 6: blue_fill}
+
+    wb_out = Workbook(write_only=True)
+    ws_out = wb_out.create_sheet()
+    # The header fills and widths of D-F make them part of the sheet even when empty
+    width = max(len(matched_rows.columns), max(header_fills))
+    ws_out.column_dimensions['D'].width = 37
+    ws_out.column_dimensions['E'].width = 80
+    ws_out.column_dimensions['F'].width = 95
+    ws_out.auto_filter.ref = f"A1:{get_column_letter(width)}{len(matched_rows) + 1}"
+
+    header_cells = []
+    for col_idx in range(1, width + 1):
+        cell = WriteOnlyCell(ws_out)
+        if col_idx <= len(matched_rows.columns):
+            cell.value, number_format = _preset_cell_value(matched_rows.columns[col_idx - 1])
+            if number_format:
+                cell.number_format = number_format
+            if col_idx in header_fills:
+                cell.fill = header_fills[col_idx]
+        header_cells.append(cell)
+    ws_out.append(header_cells)
+
+    # One style array per number format, all with the black font
+    styles = {}
+    for number_format in (None, PRESET_DATETIME_FORMAT, PRESET_DATE_FORMAT, "0"):
+        styled = WriteOnlyCell(ws_out)
+        styled.font = Font(color="000000")
+        if number_format:
+            styled.number_format = number_format
+        styles[number_format] = styled._style
+    padding = [None] * (width - len(matched_rows.columns))
+
+    for start in range(0, len(matched_rows), batch_rows):
+        for row in matched_rows.iloc[start:start + batch_rows].itertuples(index=False, name=None):
+            cells = []
+            for val in list(row) + padding:
+                value, number_format = _preset_cell_value(val)
+                cells.append(_write_only_cell(ws_out, value, styles[number_format]))
+            ws_out.append(cells)
+
+    wb_out.save(target)
@@ -0,0 +1,400 @@
+import argparse
+import base64
+import binascii
+import json
+import os
+import shutil
+import tempfile
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse
+
+from pim_engine import run_pipeline, MODE_AUTO, MODE_IN_MEMORY, MODE_COLUMNAR, MODE_STREAMING
+from delivery import write_preset_parts, write_zip_bundle
+from preflight import check_pim_file, check_part_data_file
+from preset_store import (
+    PRESET_STORE_DIR, get_preset_index, cached_preset_index, lookup_preset_snapshot,
+    current_snapshot_dir,
+)
+from run_history import RUN_HISTORY_DB, new_run_record, record_run, last_input_headers
+
+DEFAULT_HOST = "127.0.0.1"
+DEFAULT_PORT = 8765
+DEFAULT_WORKERS = 2
+# Jobs accepted beyond the running ones; further submissions get 503
+DEFAULT_QUEUE_SIZE = 4
+# Finished jobs kept for polling and downloads; older ones are dropped with their outputs
+MAX_FINISHED_JOBS = 50
+MAX_REQUEST_BYTES = 512 * 1024 * 1024
+ENGINES = (MODE_AUTO, MODE_IN_MEMORY, MODE_COLUMNAR, MODE_STREAMING)
+XLSX_MIME = "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"
+
+
+def new_service(workers=DEFAULT_WORKERS, queue_size=DEFAULT_QUEUE_SIZE,
+                preset_store_dir=PRESET_STORE_DIR, history_db=RUN_HISTORY_DB):
+    """Create the service state: the worker pool and its job slots."""
+    return {
+        'lock': threading.Lock(),
+        'jobs': {},
+        'executor': ThreadPoolExecutor(max_workers=workers, thread_name_prefix='pim-job'),
+        'workers': workers,
+        'queue_size': queue_size,
+        # One slot per running or queued job; submit_job never waits for one
+        'slots': threading.BoundedSemaphore(workers + queue_size),
+        'work_dir': tempfile.mkdtemp(prefix='pim_service_'),
+        'preset_store_dir': preset_store_dir,
+        'history_db': history_db,
+    }
+
+
+def close_service(service):
+    """Wait for the running jobs, then delete all job files."""
+    service['executor'].shutdown(wait=True, cancel_futures=True)
+    shutil.rmtree(service['work_dir'], ignore_errors=True)
+
+
+def start_preset_warmup(service):
+    """Build the current snapshot's preset index in the background so the first job does not wait."""
+    def warm_up():
+        preset_dir = current_snapshot_dir(service['preset_store_dir'])
+        if preset_dir is not None:
+            try:
+                get_preset_index(preset_dir)
+            except Exception as e:
+                print(f"Preset index warm-up failed: {e}")
+
+    threading.Thread(target=warm_up, daemon=True).start()
+
+
+def _update_job(service, job, **changes):
+    with service['lock']:
+        job.update(changes)
+
+
+def job_status(service, job):
+    """Return the JSON-ready status of a job."""
+    with service['lock']:
+        status = {
+            name: job[name]
+            for name in ('id', 'state', 'engine', 'progress', 'message', 'error', 'submitted_at', 'stats')
+        }
+        status['outputs'] = {
+            name: f"/jobs/{job['id']}/outputs/{name}" for name in job['outputs']
+        }
+        if job['outputs']:
+            status['outputs']['bundle'] = f"/jobs/{job['id']}/outputs/bundle"
+    return status
+
+
+def service_health(service):
+    """Return the worker pool load and the preset version of the service."""
+    with service['lock']:
+        states = [job['state'] for job in service['jobs'].values()]
+    preset_dir = current_snapshot_dir(service['preset_store_dir'])
+    return {
+        'workers': service['workers'],
+        'queue_size': service['queue_size'],
+        'running': states.count('running'),
+        'queued': states.count('queued'),
+        'finished': states.count('done') + states.count('error'),
+        'preset_version': os.path.basename(preset_dir) if preset_dir is not None else None,
+        'preset_index_ready': preset_dir is not None and cached_preset_index(preset_dir) is not None,
+    }
+
+
+def _write_input(job_dir, payload, name):
+    """Return the path of an input given as a server-side path or as base64 content."""
+    path = payload.get(f"{name}_path")
+    if path:
+        if not os.path.isfile(path):
+            raise ValueError(f"{name}_path not found: {path}")
+        return path
+    content = payload.get(name)
+    if not content:
+        raise ValueError(f"Missing {name} (base64 content) or {name}_path")
+    try:
+        data = base64.b64decode(content, validate=True)
+    except (binascii.Error, TypeError) as e:
+        raise ValueError(f"{name} is not valid base64 ({e})")
+    path = os.path.join(job_dir, f"{name}.xlsx")
+    with open(path, 'wb') as f:
+        f.write(data)
+    return path
+
+
+class PreflightError(Exception):
+    """Raised when a submitted job fails its pre-flight checks."""
+
+    def __init__(self, reports):
+        super().__init__("Pre-flight checks failed")
+        self.reports = reports
+
+
+def submit_job(service, payload):
+    """Validate and queue a job; returns (HTTP status, response body).
+
+    payload holds pim_file and part_data_file as base64 content, or
+    pim_file_path and part_data_file_path on the server, plus an optional
+    engine (default 'auto') and force=true to skip the pre-flight errors.
+    """
+    engine = payload.get('engine') or MODE_AUTO
+    if engine not in ENGINES:
+        return 400, {'error': f"Unknown engine '{engine}', expected one of {', '.join(ENGINES)}"}
+    if current_snapshot_dir(service['preset_store_dir']) is None:
+        return 409, {'error': "No preset database found. Upload one in the app's Settings page first."}
+    # Backpressure: reject instead of queueing without bound
+    if not service['slots'].acquire(blocking=False):
+        return 503, {'error': "All workers are busy and the queue is full; retry later"}
+
+    job_id = uuid.uuid4().hex[:12]
+    job_dir = os.path.join(service['work_dir'], job_id)
+    try:
+        os.makedirs(job_dir)
+        pim_path = _write_input(job_dir, payload, 'pim_file')
+        part_data_path = _write_input(job_dir, payload, 'part_data_file')
+
+        try:
+            expected_headers = last_input_headers(service['history_db'])
+        except Exception:
+            expected_headers = {'pim_header': None, 'part_data_header': None}
+        reports = [
+            check_pim_file(pim_path, expected_headers['pim_header']),
+            check_part_data_file(part_data_path, expected_headers['part_data_header']),
+        ]
+        if any(report['errors'] for report in reports) and not payload.get('force'):
+            raise PreflightError(reports)
+
+        job = {
+            'id': job_id,
+            'state': 'queued',
+            'engine': engine,
+            'progress': 0,
+            'message': "Queued",
+            'error': None,
+            'submitted_at': datetime.now().isoformat(timespec='seconds'),
+            'stats': None,
+            'outputs': {},
+            'dir': job_dir,
+            'input_headers': {'pim_header': reports[0]['header'], 'part_data_header': reports[1]['header']},
+        }
+        with service['lock']:
+            service['jobs'][job_id] = job
+        service['executor'].submit(_run_job, service, job, pim_path, part_data_path)
+    except Exception as e:
+        # Whatever failed, the job never reaches a worker: give its slot back
+        with service['lock']:
+            service['jobs'].pop(job_id, None)
+        shutil.rmtree(job_dir, ignore_errors=True)
+        service['slots'].release()
+        if isinstance(e, ValueError):
+            return 400, {'error': str(e)}
+        if isinstance(e, PreflightError):
+            return 422, {'error': "Pre-flight checks failed; resubmit with force=true to run anyway",
+                         'preflight': e.reports}
+        return 500, {'error': f"Could not accept the job ({e})"}
+    return 202, {'id': job_id, 'status_url': f"/jobs/{job_id}"}
+
+
+def _run_job(service, job, pim_path, part_data_path):
+    """Run one job on a worker thread and record it in the run history."""
+    record = new_run_record()
+    run_started = time.perf_counter()
+    _update_job(service, job, state='running', message="Starting...")
+    try:
+        # Inside the try: a *_path input can be moved or deleted while the job is queued
+        record['pim_bytes'] = os.path.getsize(pim_path)
+        record['part_data_bytes'] = os.path.getsize(part_data_path)
+        record.update(job['input_headers'])
+        # Pin the current preset snapshot for the whole job
+        preset_dir = current_snapshot_dir(service['preset_store_dir'])
+        if preset_dir is None:
+            raise RuntimeError("No preset database found")
+        record['preset_version'] = os.path.basename(preset_dir)
+
+        def lookup_preset(lookup_values):
+            if cached_preset_index(preset_dir) is None:
+                # Index the snapshot for later jobs; this one reads only the shards it needs
+                start_preset_warmup(service)
+            return lookup_preset_snapshot(preset_dir, lookup_values)
+
+        current_date = datetime.now().strftime("%d_%m_%Y")
+        pim_output = os.path.join(job['dir'], f"PIM_Processed_{current_date}.xlsx")
+        matched_rows, stats = run_pipeline(
+            pim_path, part_data_path, lookup_preset, pim_output,
+            status_callback=lambda message: _update_job(service, job, message=message),
+            progress_callback=lambda value: _update_job(service, job, progress=value),
+            mode=job['engine'],
+        )
+        record.update(stats)
+        outputs = {'pim': pim_output}
+
+        preset_started = time.perf_counter()
+        if not matched_rows.empty:
+            # Results beyond Excel's row limit are split into preset_part1, preset_part2, ...
+            preset_parts = write_preset_parts(matched_rows, job['dir'], f"DK_Preset_{current_date}.xlsx")
+            if len(preset_parts) == 1:
+                outputs['preset'] = preset_parts[0]
+            else:
+                outputs.update({f"preset_part{part}": path for part, path in enumerate(preset_parts, start=1)})
+        record['step_durations']['write_preset'] = round(time.perf_counter() - preset_started, 4)
+
+        record['status'] = 'ok'
+        _update_job(service, job, state='done', progress=100, message="All steps completed successfully!",
+                    stats=stats, outputs=outputs)
+    except Exception as e:
+        record['status'] = 'error'
+        record['error'] = str(e)
+        _update_job(service, job, state='error', message=f"Error: {e}", error=str(e))
+    finally:
+        record['duration_seconds'] = round(time.perf_counter() - run_started, 4)
+        try:
+            record_run(record, service['history_db'])
+        except Exception:
+            pass
+        service['slots'].release()
+        _drop_old_jobs(service)
+
+
+def _drop_old_jobs(service):
+    """Drop the oldest finished jobs beyond MAX_FINISHED_JOBS, with their files."""
+    with service['lock']:
+        finished = [job for job in service['jobs'].values() if job['state'] in ('done', 'error')]
+        dropped = finished[:max(len(finished) - MAX_FINISHED_JOBS, 0)]
+        for job in dropped:
+            del service['jobs'][job['id']]
+    for job in dropped:
+        shutil.rmtree(job['dir'], ignore_errors=True)
+
+
+def delete_job(service, job_id):
+    """Drop a finished job and its files; returns (HTTP status, response body)."""
+    with service['lock']:
+        job = service['jobs'].get(job_id)
+        if job is None:
+            return 404, {'error': f"Unknown job {job_id}"}
+        if job['state'] not in ('done', 'error'):
+            return 409, {'error': f"Job {job_id} is {job['state']}"}
+        del service['jobs'][job_id]
+    shutil.rmtree(job['dir'], ignore_errors=True)
+    return 200, {'deleted': job_id}
+
+
+class ServiceHandler(BaseHTTPRequestHandler):
+    """Route the HTTP endpoints to the service functions."""
+
+    server_version = "PIMService/1.0"
+
+    def _send_json(self, status, body, headers=None):
+        data = json.dumps(body, default=str).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(data)
+
+    def _route(self):
+        return [part for part in urlparse(self.path).path.split('/') if part]
+
+    def _find_job(self, job_id):
+        with self.server.service['lock']:
+            return self.server.service['jobs'].get(job_id)
+
+    def do_GET(self):
+        service = self.server.service
+        parts = self._route()
+        if parts == ['health']:
+            return self._send_json(200, service_health(service))
+        if len(parts) in (2, 4) and parts[0] == 'jobs':
+            job = self._find_job(parts[1])
+            if job is None:
+                return self._send_json(404, {'error': f"Unknown job {parts[1]}"})
+            if len(parts) == 2:
+                return self._send_json(200, job_status(service, job))
+            if parts[2] == 'outputs':
+                return self._send_output(job, parts[3])
+        self._send_json(404, {'error': "Not found"})
+
+    def _send_output(self, job, name):
+        with self.server.service['lock']:
+            outputs = dict(job['outputs'])
+        if name == 'bundle' and outputs:
+            return self._send_bundle(job, list(outputs.values()))
+        path = outputs.get(name)
+        if path is None:
+            return self._send_json(404, {'error': f"Job {job['id']} has no '{name}' output"})
+        self.send_response(200)
+        self.send_header("Content-Type", XLSX_MIME)
+        self.send_header("Content-Length", str(os.path.getsize(path)))
+        self.send_header("Content-Disposition", f'attachment; filename="{os.path.basename(path)}"')
+        self.end_headers()
+        with open(path, 'rb') as f:
+            shutil.copyfileobj(f, self.wfile)
+
+    def _send_bundle(self, job, paths):
+        """Stream all outputs of a job as one zip, generated while it is sent."""
+        self.send_response(200)
+        self.send_header("Content-Type", "application/zip")
+        self.send_header("Content-Disposition", f'attachment; filename="PIM_Results_{job["id"]}.zip"')
+        # No Content-Length: the HTTP/1.0 response ends when the connection closes
+        self.end_headers()
+        write_zip_bundle(self.wfile, paths)
+
+    def do_POST(self):
+        if self._route() != ['jobs']:
+            return self._send_json(404, {'error': "Not found"})
+        length = int(self.headers.get("Content-Length") or 0)
+        if length > MAX_REQUEST_BYTES:
+            return self._send_json(413, {'error': f"Request larger than {MAX_REQUEST_BYTES} bytes"})
+        try:
+            payload = json.loads(self.rfile.read(length) or b"{}")
+        except ValueError as e:
+            return self._send_json(400, {'error': f"Invalid JSON ({e})"})
+        if not isinstance(payload, dict):
+            return self._send_json(400, {'error': "Expected a JSON object"})
+        status, body = submit_job(self.server.service, payload)
+        self._send_json(status, body, {"Retry-After": "5"} if status == 503 else None)
+
+    def do_DELETE(self):
+        parts = self._route()
+        if len(parts) != 2 or parts[0] != 'jobs':
+            return self._send_json(404, {'error': "Not found"})
+        self._send_json(*delete_job(self.server.service, parts[1]))
+
+
+def make_server(host=DEFAULT_HOST, port=DEFAULT_PORT, **service_options):
+    """Create the HTTP server and its service state; port 0 picks a free port."""
+    server = ThreadingHTTPServer((host, port), ServiceHandler)
+    server.daemon_threads = True
+    server.service = new_service(**service_options)
+    start_preset_warmup(server.service)
+    return server
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Local HTTP processing service for PIM reports")
+    parser.add_argument("--host", default=DEFAULT_HOST)
+    parser.add_argument("--port", type=int, default=DEFAULT_PORT)
+    parser.add_argument("--workers", type=int, default=DEFAULT_WORKERS)
+    parser.add_argument("--queue-size", type=int, default=DEFAULT_QUEUE_SIZE)
+    args = parser.parse_args()
+
+    server = make_server(args.host, args.port, workers=args.workers, queue_size=args.queue_size)
+    print(f"PIM service listening on http://{args.host}:{server.server_address[1]} "
+          f"({args.workers} workers, queue of {args.queue_size})")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        close_service(server.service)
+
+
+if __name__ == "__main__":
+    main()
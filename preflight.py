@@ -0,0 +1,166 @@
+import time
+
+from openpyxl.utils import get_column_letter
+
+from pim_engine import FILTER_KEYWORDS, PART_KEY_COLS, PART_Q_COL, PART_S_COL
+from preset_store import PRESET_KEY_COLUMN
+from xlsx_inspect import inspect_workbook, sheet_contains_text
+
+# PIM columns (1-based) the pipeline reads by position: the C & D key,
+# the H filter column and the L & M part data key
+PIM_KEY_COLS = (3, 4, 8, 12, 13)
+PIM_FILTER_COL = 8
+PIM_PART_KEY_COLS = (12, 13)
+
+
+def _new_report(kind, workbook=None):
+    return {
+        'kind': kind,
+        'rows': workbook['rows'] if workbook else None,
+        'cols': workbook['cols'] if workbook else None,
+        'header': workbook['header'] if workbook else [],
+        'errors': [],
+        'warnings': [],
+        'seconds': None,
+    }
+
+
+def _inspect(kind, source):
+    """Read an upload's metadata into a new report, recording unreadable files as errors."""
+    try:
+        workbook = inspect_workbook(source)
+    except Exception as e:
+        report = _new_report(kind)
+        report['errors'].append(f"{kind} file is not a readable Excel workbook ({e})")
+        return None, report
+    return workbook, _new_report(kind, workbook)
+
+
+def _header_value(header, col_idx):
+    return header[col_idx - 1] if col_idx <= len(header) else None
+
+
+def _check_layout(report, expected_header, key_cols, reference="the last successful run"):
+    """Compare the header row with an expected one, by default the last successful run's.
+
+    A key column whose header now sits in another column is an error, since
+    the pipeline reads those columns by position; other changes are warnings.
+    """
+    if not expected_header:
+        return
+    header = report['header']
+    kind = report['kind']
+    for col_idx in key_cols:
+        expected = _header_value(expected_header, col_idx)
+        actual = _header_value(header, col_idx)
+        if expected is None or actual == expected:
+            continue
+        if expected in header:
+            report['errors'].append(
+                f"{kind} column '{expected}' moved from {get_column_letter(col_idx)} "
+                f"to {get_column_letter(header.index(expected) + 1)}"
+            )
+        else:
+            report['warnings'].append(
+                f"{kind} column {get_column_letter(col_idx)} is '{actual}', "
+                f"expected '{expected}' as in {reference}"
+            )
+    changed = [
+        get_column_letter(col_idx)
+        for col_idx in range(1, max(len(header), len(expected_header)) + 1)
+        if col_idx not in key_cols and _header_value(header, col_idx) != _header_value(expected_header, col_idx)
+    ]
+    if changed:
+        report['warnings'].append(
+            f"{kind} header differs from {reference} in column(s) {', '.join(changed)}"
+        )
+
+
+def check_pim_file(source, expected_header=None):
+    """Pre-flight check of a PIM report from its xlsx metadata.
+
+    Checks that column H exists and that some cell text contains one of the
+    filter keywords, that the L & M part key columns exist, and, given the
+    header of the last successful run, that no key column moved.
+    """
+    started = time.perf_counter()
+    workbook, report = _inspect("PIM", source)
+    if workbook is not None:
+        if workbook['rows'] <= 1:
+            report['errors'].append("PIM file has no data rows below the header")
+        if workbook['cols'] < PIM_FILTER_COL:
+            report['errors'].append(
+                f"PIM file has {workbook['cols']} columns; rows are selected by the keywords in column H"
+            )
+        else:
+            keywords_found = any(
+                keyword in text.lower() for text in workbook['shared_strings'] for keyword in FILTER_KEYWORDS
+            )
+            if not keywords_found and workbook['inline_strings']:
+                keywords_found = sheet_contains_text(source, FILTER_KEYWORDS)
+            if not keywords_found:
+                report['errors'].append(
+                    "No cell text in the PIM file contains "
+                    + ", ".join(f"'{keyword}'" for keyword in FILTER_KEYWORDS)
+                    + "; no rows would be selected by column H"
+                )
+        if workbook['cols'] < max(PIM_PART_KEY_COLS):
+            report['warnings'].append(
+                "PIM file has no columns L and M; the Datasheet lookup will find no part data"
+            )
+        _check_layout(report, expected_header, PIM_KEY_COLS)
+    report['seconds'] = round(time.perf_counter() - started, 3)
+    return report
+
+
+def check_part_data_file(source, expected_header=None):
+    """Pre-flight check of a Part Data file from its xlsx metadata.
+
+    Checks that the C & D key and the Datasheet columns (P and R, the Q and S
+    of the old layout) exist and, given the header of the last successful
+    run, that none of them moved.
+    """
+    started = time.perf_counter()
+    workbook, report = _inspect("Part Data", source)
+    if workbook is not None:
+        if workbook['rows'] <= 1:
+            report['warnings'].append("Part Data file has no data rows below the header")
+        if workbook['cols'] < PART_S_COL:
+            report['errors'].append(
+                f"Part Data file has {workbook['cols']} columns; the Datasheet values are read from "
+                f"columns {get_column_letter(PART_Q_COL)} and {get_column_letter(PART_S_COL)}"
+            )
+        for col_idx in PART_KEY_COLS + (PART_Q_COL, PART_S_COL):
+            if col_idx <= workbook['cols'] and _header_value(workbook['header'], col_idx) is None:
+                report['warnings'].append(
+                    f"Part Data column {get_column_letter(col_idx)} has no header; check that the columns did not move"
+                )
+        _check_layout(report, expected_header, PART_KEY_COLS + (PART_Q_COL, PART_S_COL))
+    report['seconds'] = round(time.perf_counter() - started, 3)
+    return report
+
+
+def check_preset_file(source, current_columns=None):
+    """Pre-flight check of a preset Excel file from its xlsx metadata.
+
+    Checks the key column E of the first sheet and, given the columns of the
+    current preset database, that the key column did not move.
+    """
+    started = time.perf_counter()
+    workbook, report = _inspect("Preset", source)
+    key_col = PRESET_KEY_COLUMN + 1
+    if workbook is not None:
+        if workbook['rows'] <= 1:
+            report['errors'].append("Preset file has no data rows below the header")
+        if workbook['cols'] < key_col:
+            report['errors'].append(
+                f"Preset file has {workbook['cols']} columns; the lookup key is read from column {get_column_letter(key_col)}"
+            )
+        if current_columns:
+            # pandas names empty headers "Unnamed: <n>"
+            expected_header = [
+                None if str(column).startswith("Unnamed:") else str(column) for column in current_columns
+            ]
+            _check_layout(report, expected_header, (key_col,), "the current preset database")
+    report['seconds'] = round(time.perf_counter() - started, 3)
+    return report
@@ -0,0 +1,585 @@
+import hashlib
+import json
+import os
+import pickle
+import shutil
+import threading
+import time
+import uuid
+import zlib
+from collections import OrderedDict
+from datetime import datetime
+
+# pandas/numpy are imported inside the functions that need them so the
+# Streamlit main page can render before they finish importing.
+
+# Snapshot store root of the web app and the processing service
+PRESET_STORE_DIR = "preset_store"
+# Step 11 matches the PIM report's P column against the preset's 5th column
+PRESET_KEY_COLUMN = 4
+# Shards are sized so a run's few thousand keys touch a small share of them:
+# the shard count follows the row count, within these bounds
+PRESET_SHARD_ROWS = 256
+MIN_NUM_SHARDS = 16
+MAX_NUM_SHARDS = 16384
+MANIFEST_NAME = "manifest.json"
+PREVIEW_NAME = "preview.pkl"
+PREVIEW_ROWS = 10
+KEYS_NAME = "keys.pkl"
+COLUMNS_NAME = "columns.pkl"
+# Shards written as {key: [(position, row values)]}; older stores pickled
+# each shard as a DataFrame
+SHARD_FORMAT_ROWS = "rows"
+# Versioned snapshots live under <root>/snapshots; CURRENT names the active one
+SNAPSHOTS_DIR = "snapshots"
+CURRENT_POINTER = "CURRENT"
+TEMP_PREFIX = ".tmp-"
+# Superseded snapshots are kept at least this long so in-flight runs can finish
+DEFAULT_RETENTION_SECONDS = 3600
+# When each snapshot stopped being current, which starts its retention window
+SUPERSEDED_LOG = "superseded.json"
+# Text columns with at most this share of distinct values are stored as categoricals
+CATEGORY_MAX_UNIQUE_RATIO = 0.5
+# Key indexes kept in memory per process, one per snapshot directory
+PRESET_INDEX_CACHE_SIZE = 4
+# Excel preset sources get a snapshot store next to them, described by source.json
+SOURCE_CACHE_SUFFIX = "_preset_cache"
+SOURCE_MANIFEST_NAME = "source.json"
+
+
+def dataframe_memory_mb(df):
+    """Return the deep memory usage of a DataFrame in megabytes."""
+    return df.memory_usage(deep=True).sum() / (1024 * 1024)
+
+
+def compact_preset_df(df):
+    """Shrink the preset DataFrame's memory without changing its values.
+
+    Repetitive text columns become categoricals and integer columns are
+    downcast. Float columns are left alone because a narrower float would
+    change the values written to the DK Preset output.
+    """
+    import pandas as pd
+
+    df = df.reset_index(drop=True)
+    for col_idx in range(df.shape[1]):
+        series = df.iloc[:, col_idx]
+        if pd.api.types.is_integer_dtype(series.dtype):
+            df.isetitem(col_idx, pd.to_numeric(series, downcast='integer'))
+        elif pd.api.types.is_object_dtype(series.dtype) or pd.api.types.is_string_dtype(series.dtype):
+            if len(series) and series.nunique(dropna=False) <= len(series) * CATEGORY_MAX_UNIQUE_RATIO:
+                try:
+                    df.isetitem(col_idx, series.astype('category'))
+                except TypeError:
+                    # Mixed values that cannot form categories stay as they are
+                    pass
+    return df
+
+
+def read_preset_excel(source):
+    """Read every sheet of a preset Excel file into one DataFrame.
+
+    Returns the DataFrame and the number of sheets read.
+    """
+    import pandas as pd
+
+    df_dict = pd.read_excel(source, sheet_name=None)
+    return pd.concat(df_dict.values(), ignore_index=True), len(df_dict)
+
+
+def shard_id_for_key(key, num_shards):
+    """Return the shard a preset key belongs to (stable across processes)."""
+    return zlib.crc32(str(key).encode('utf-8')) % num_shards
+
+
+def num_shards_for_rows(rows):
+    """Return the shard count for a preset of rows rows (about PRESET_SHARD_ROWS each)."""
+    return min(max(-(-rows // PRESET_SHARD_ROWS), MIN_NUM_SHARDS), MAX_NUM_SHARDS)
+
+
+def shard_filename(shard_id):
+    """Return the file name of a shard inside the store directory."""
+    return f"shard_{shard_id:05d}.pkl"
+
+
+def preset_keys(df):
+    """Return the lookup keys of a preset DataFrame as Step 11 compares them."""
+    return df.iloc[:, PRESET_KEY_COLUMN].astype(str)
+
+
+def write_preset_store(df, store_dir, num_shards=None):
+    """Write the preset DataFrame as hash-partitioned shards plus a manifest.
+
+    Each shard maps its keys to their (source position, row values), so a
+    lookup reads only the rows of the requested keys without building a
+    DataFrame per shard, and the source order can be restored after reading
+    several shards. num_shards defaults to num_shards_for_rows(len(df)).
+    """
+    df = df.reset_index(drop=True)
+    num_shards = num_shards or num_shards_for_rows(len(df))
+    keys = preset_keys(df)
+    shard_of_key = {key: shard_id_for_key(key, num_shards) for key in keys.unique()}
+    shard_ids = keys.map(shard_of_key)
+
+    if os.path.exists(store_dir):
+        shutil.rmtree(store_dir)
+    os.makedirs(store_dir)
+
+    shards = {}
+
+    def write_shard(shard_id, shard_rows):
+        filename = shard_filename(shard_id)
+        with open(os.path.join(store_dir, filename), 'wb') as f:
+            pickle.dump(shard_rows, f, pickle.HIGHEST_PROTOCOL)
+        shards[str(shard_id)] = {'file': filename, 'rows': sum(len(rows) for rows in shard_rows.values())}
+
+    # One pass over the rows in shard order, writing each shard as it completes
+    order = shard_ids.argsort(kind='stable').to_numpy()
+    shard_id, shard_rows = None, {}
+    for row_shard, key, position, row in zip(
+        shard_ids.iloc[order], keys.iloc[order], order, df.take(order).itertuples(index=False, name=None)
+    ):
+        if row_shard != shard_id:
+            if shard_rows:
+                write_shard(shard_id, shard_rows)
+            shard_id, shard_rows = row_shard, {}
+        shard_rows.setdefault(key, []).append((int(position), row))
+    if shard_rows:
+        write_shard(shard_id, shard_rows)
+
+    with open(os.path.join(store_dir, PREVIEW_NAME), 'wb') as f:
+        pickle.dump(df.head(PREVIEW_ROWS), f)
+    with open(os.path.join(store_dir, KEYS_NAME), 'wb') as f:
+        pickle.dump(list(shard_of_key), f)
+    with open(os.path.join(store_dir, COLUMNS_NAME), 'wb') as f:
+        pickle.dump(df.columns, f)
+
+    manifest = {
+        'num_shards': num_shards,
+        'shard_format': SHARD_FORMAT_ROWS,
+        'hash': 'crc32',
+        'key_column': PRESET_KEY_COLUMN,
+        'rows': len(df),
+        'columns': [str(col) for col in df.columns],
+        'memory_bytes': int(df.memory_usage(deep=True).sum()),
+        'created': datetime.now().isoformat(timespec='seconds'),
+        'shards': shards,
+    }
+    with open(os.path.join(store_dir, MANIFEST_NAME), 'w') as f:
+        json.dump(manifest, f, indent=2)
+    return manifest
+
+
+def preset_store_exists(store_dir):
+    """Return True if a complete preset store is present."""
+    return os.path.exists(os.path.join(store_dir, MANIFEST_NAME))
+
+
+def read_manifest(store_dir):
+    """Load the shard manifest of a preset store."""
+    with open(os.path.join(store_dir, MANIFEST_NAME)) as f:
+        return json.load(f)
+
+
+def load_shard(store_dir, manifest, shard_id):
+    """Load one shard, or None if no preset row hashes to it."""
+    shard_info = manifest['shards'].get(str(shard_id))
+    if shard_info is None:
+        return None
+    with open(os.path.join(store_dir, shard_info['file']), 'rb') as f:
+        return pickle.load(f)
+
+
+def load_preset_rows(store_dir, lookup_values):
+    """Return the preset rows whose key is in lookup_values, in source order.
+
+    Only the shards that can contain one of the requested keys are read,
+    and only the rows of those keys are taken from them.
+    """
+    import pandas as pd
+
+    manifest = read_manifest(store_dir)
+    keys_by_shard = {}
+    for val in set(str(val) for val in lookup_values):
+        keys_by_shard.setdefault(shard_id_for_key(val, manifest['num_shards']), []).append(val)
+    if manifest.get('shard_format') != SHARD_FORMAT_ROWS:
+        return _load_frame_shard_rows(store_dir, manifest, keys_by_shard)
+
+    matched = []
+    for shard_id in sorted(keys_by_shard):
+        shard_rows = load_shard(store_dir, manifest, shard_id)
+        if shard_rows is None:
+            continue
+        for key in keys_by_shard[shard_id]:
+            matched.extend(shard_rows.get(key, ()))
+
+    if not matched:
+        return load_preset_preview(store_dir).iloc[0:0]
+    matched.sort(key=lambda match: match[0])
+    with open(os.path.join(store_dir, COLUMNS_NAME), 'rb') as f:
+        columns = pickle.load(f)
+    return pd.DataFrame(
+        [row for position, row in matched],
+        index=[position for position, row in matched],
+        columns=columns,
+    )
+
+
+def _load_frame_shard_rows(store_dir, manifest, keys_by_shard):
+    """load_preset_rows for stores whose shards are pickled DataFrames."""
+    import pandas as pd
+
+    matched = []
+    for shard_id in sorted(keys_by_shard):
+        shard_df = load_shard(store_dir, manifest, shard_id)
+        if shard_df is None:
+            continue
+        matched.append(shard_df[preset_keys(shard_df).isin(keys_by_shard[shard_id])])
+
+    if not matched:
+        return load_preset_preview(store_dir).iloc[0:0]
+    return pd.concat(matched).sort_index()
+
+
+def load_preset_preview(store_dir):
+    """Load the first rows of the preset database for display."""
+    with open(os.path.join(store_dir, PREVIEW_NAME), 'rb') as f:
+        return pickle.load(f)
+
+
+def _hash_keys(keys):
+    import numpy as np
+    import pandas as pd
+
+    return pd.util.hash_array(np.asarray(keys, dtype=object))
+
+
+def build_preset_index(store_dir):
+    """Build the in-memory key index of a preset store.
+
+    The index keeps a sorted array of 64-bit key hashes (8 bytes per key)
+    so a run can tell which requested keys exist without opening shards.
+    """
+    import numpy as np
+
+    manifest = read_manifest(store_dir)
+    keys_path = os.path.join(store_dir, KEYS_NAME)
+    if os.path.exists(keys_path):
+        with open(keys_path, 'rb') as f:
+            keys = pickle.load(f)
+    else:
+        # Stores written before the key list existed: collect keys from the shards
+        keys = []
+        for shard_id in manifest['shards']:
+            keys.extend(preset_keys(load_shard(store_dir, manifest, shard_id)).unique())
+    # Missing keys stay NaN after astype(str) and can never match a lookup
+    keys = [key for key in keys if isinstance(key, str)]
+    return {
+        'dir': store_dir,
+        'manifest': manifest,
+        'key_hashes': np.unique(_hash_keys(keys)),
+    }
+
+
+_index_cache = {'lock': threading.Lock(), 'entries': OrderedDict()}
+
+
+def get_preset_index(store_dir):
+    """Return the key index of a snapshot, built once and shared by every run in the process.
+
+    Snapshot directories never change once published, so each has its own
+    cache entry: runs pinned to the old and the new snapshot after an upload
+    do not rebuild each other's index, and a build only blocks the runs
+    waiting for the same snapshot. The least recently used entries beyond
+    PRESET_INDEX_CACHE_SIZE are dropped.
+    """
+    key = os.path.abspath(store_dir)
+    with _index_cache['lock']:
+        entries = _index_cache['entries']
+        entry = entries.get(key)
+        if entry is None:
+            entry = entries[key] = {'lock': threading.Lock(), 'index': None}
+        entries.move_to_end(key)
+        while len(entries) > PRESET_INDEX_CACHE_SIZE:
+            entries.popitem(last=False)
+    with entry['lock']:
+        if entry['index'] is None:
+            entry['index'] = build_preset_index(store_dir)
+        return entry['index']
+
+
+def cached_preset_index(store_dir):
+    """Return the cached key index of a snapshot, or None if it is not built yet."""
+    with _index_cache['lock']:
+        entry = _index_cache['entries'].get(os.path.abspath(store_dir))
+    return entry['index'] if entry is not None else None
+
+
+def lookup_preset_index(index, lookup_values):
+    """Return the preset rows for lookup_values using a prebuilt key index.
+
+    Keys missing from the index are dropped before any shard is opened.
+    """
+    import numpy as np
+
+    lookup_values = list(set(str(val) for val in lookup_values))
+    if lookup_values:
+        present = np.isin(_hash_keys(lookup_values), index['key_hashes'])
+        lookup_values = [val for val, found in zip(lookup_values, present) if found]
+    return load_preset_rows(index['dir'], lookup_values)
+
+
+def lookup_preset_snapshot(store_dir, lookup_values):
+    """Return the preset rows for lookup_values from a snapshot.
+
+    Uses the snapshot's key index if it is already built. A cold run does
+    not wait for the index, which loads every key of the snapshot: it reads
+    the shards of the requested keys directly.
+    """
+    index = cached_preset_index(store_dir)
+    if index is None:
+        return load_preset_rows(store_dir, lookup_values)
+    return lookup_preset_index(index, lookup_values)
+
+
+def _snapshots_dir(root):
+    return os.path.join(root, SNAPSHOTS_DIR)
+
+
+def _new_snapshot_version():
+    """Return a unique snapshot name that sorts in creation order."""
+    return f"{datetime.now().strftime('%Y%m%d-%H%M%S-%f')}-{uuid.uuid4().hex[:6]}"
+
+
+def _read_superseded_log(root):
+    """Return {snapshot name: time it stopped being current} for root."""
+    try:
+        with open(os.path.join(root, SUPERSEDED_LOG)) as f:
+            return json.load(f)
+    except (FileNotFoundError, ValueError):
+        return {}
+
+
+def _write_current_pointer(root, version):
+    """Atomically point CURRENT at a snapshot (or remove it for None).
+
+    The snapshot the pointer moves away from is logged as superseded now,
+    before the pointer moves, so its retention window starts here.
+    """
+    previous = current_snapshot_version(root)
+    if previous != version:
+        superseded = _read_superseded_log(root)
+        if previous is not None:
+            superseded[previous] = time.time()
+        superseded.pop(version, None)
+        _write_json_atomic(os.path.join(root, SUPERSEDED_LOG), superseded)
+    pointer_path = os.path.join(root, CURRENT_POINTER)
+    if version is None:
+        if os.path.exists(pointer_path):
+            os.remove(pointer_path)
+        return
+    tmp_path = os.path.join(root, f"{TEMP_PREFIX}{CURRENT_POINTER}-{uuid.uuid4().hex}")
+    with open(tmp_path, 'w') as f:
+        f.write(version)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, pointer_path)
+
+
+def list_preset_snapshots(root):
+    """Return the names of all complete snapshots, oldest first."""
+    snapshots_dir = _snapshots_dir(root)
+    if not os.path.isdir(snapshots_dir):
+        return []
+    return sorted(
+        name for name in os.listdir(snapshots_dir)
+        if not name.startswith(TEMP_PREFIX) and preset_store_exists(os.path.join(snapshots_dir, name))
+    )
+
+
+def current_snapshot_version(root):
+    """Return the name of the active snapshot, or None if there is none."""
+    try:
+        with open(os.path.join(root, CURRENT_POINTER)) as f:
+            version = f.read().strip()
+    except FileNotFoundError:
+        return None
+    if not version or not preset_store_exists(os.path.join(_snapshots_dir(root), version)):
+        return None
+    return version
+
+
+def current_snapshot_dir(root):
+    """Resolve the active snapshot directory once; readers keep using it.
+
+    A run that resolved its directory before a new snapshot was published
+    keeps reading the old snapshot until it finishes.
+    """
+    version = current_snapshot_version(root)
+    if version is None:
+        return None
+    return os.path.join(_snapshots_dir(root), version)
+
+
+def previous_snapshot_version(root):
+    """Return the newest snapshot older than the active one, or None."""
+    current = current_snapshot_version(root)
+    older = [name for name in list_preset_snapshots(root) if current is None or name < current]
+    return older[-1] if older else None
+
+
+def publish_preset_snapshot(df, root, num_shards=None, retention_seconds=DEFAULT_RETENTION_SECONDS):
+    """Write df as a new snapshot beside the current one and switch to it.
+
+    The snapshot is built under a temporary name, renamed into place and
+    only then made current, so readers never see a partially written store.
+    Concurrent publishes each produce their own snapshot; the last to swap
+    the pointer wins.
+    """
+    version = _new_snapshot_version()
+    snapshots_dir = _snapshots_dir(root)
+    os.makedirs(snapshots_dir, exist_ok=True)
+    tmp_dir = os.path.join(snapshots_dir, f"{TEMP_PREFIX}{version}")
+    write_preset_store(df, tmp_dir, num_shards)
+    os.rename(tmp_dir, os.path.join(snapshots_dir, version))
+    _write_current_pointer(root, version)
+    gc_preset_snapshots(root, retention_seconds)
+    return version
+
+
+def rollback_preset_snapshot(root):
+    """Make the previous snapshot current again. Returns its name or None."""
+    version = previous_snapshot_version(root)
+    if version is not None:
+        _write_current_pointer(root, version)
+    return version
+
+
+def deactivate_preset_snapshots(root, retention_seconds=DEFAULT_RETENTION_SECONDS):
+    """Remove the CURRENT pointer; snapshots are collected after retention."""
+    _write_current_pointer(root, None)
+    gc_preset_snapshots(root, retention_seconds)
+
+
+def gc_preset_snapshots(root, retention_seconds=DEFAULT_RETENTION_SECONDS):
+    """Delete snapshots superseded longer ago than the retention window.
+
+    The window starts when a snapshot stopped being current, as logged in
+    SUPERSEDED_LOG. Snapshots missing from the log (never current, still
+    being written, superseded before the log existed or dropped by a
+    concurrent log update) are logged as superseded now, so they too are
+    kept for a full window. The current snapshot and the one before it (the
+    rollback target) are always kept. Returns the names of the removed
+    snapshots.
+    """
+    snapshots_dir = _snapshots_dir(root)
+    if not os.path.isdir(snapshots_dir):
+        return []
+    current = current_snapshot_version(root)
+    protected = {current, previous_snapshot_version(root)} if current else set()
+    superseded = _read_superseded_log(root)
+    now = time.time()
+    kept = {}
+    removed = []
+    for name in os.listdir(snapshots_dir):
+        if name in protected:
+            if name in superseded:
+                kept[name] = superseded[name]
+            continue
+        superseded_at = superseded.get(name, now)
+        if superseded_at > now - retention_seconds:
+            kept[name] = superseded_at
+            continue
+        shutil.rmtree(os.path.join(snapshots_dir, name), ignore_errors=True)
+        removed.append(name)
+    if kept != superseded:
+        _write_json_atomic(os.path.join(root, SUPERSEDED_LOG), kept)
+    return removed
+
+
+def migrate_flat_preset_store(root):
+    """Move a store written directly into root into its first snapshot."""
+    if not preset_store_exists(root):
+        return None
+    version = _new_snapshot_version()
+    snapshot_dir = os.path.join(_snapshots_dir(root), version)
+    os.makedirs(snapshot_dir)
+    for name in os.listdir(root):
+        if name.endswith('.pkl') or name == MANIFEST_NAME:
+            shutil.move(os.path.join(root, name), os.path.join(snapshot_dir, name))
+    _write_current_pointer(root, version)
+    return version
+
+
+def source_cache_root(source_path):
+    """Return the snapshot store directory kept next to a preset source file."""
+    return os.path.splitext(source_path)[0] + SOURCE_CACHE_SUFFIX
+
+
+def _file_sha256(path):
+    sha256 = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b''):
+            sha256.update(chunk)
+    return sha256.hexdigest()
+
+
+def _write_json_atomic(path, data):
+    tmp_path = f"{path}.{uuid.uuid4().hex}.tmp"
+    with open(tmp_path, 'w') as f:
+        json.dump(data, f, indent=2)
+    os.replace(tmp_path, path)
+
+
+def cached_source_snapshot(source_path):
+    """Return the cached snapshot of source_path if the source is unchanged.
+
+    Path, size and mtime are compared first; if only the mtime differs the
+    content hash decides, so re-saving or copying an identical file does not
+    force a rebuild. Returns None when the cache is missing or stale.
+    """
+    cache_root = source_cache_root(source_path)
+    manifest_path = os.path.join(cache_root, SOURCE_MANIFEST_NAME)
+    try:
+        with open(manifest_path) as f:
+            manifest = json.load(f)
+    except (FileNotFoundError, ValueError):
+        return None
+    snapshot_dir = current_snapshot_dir(cache_root)
+    if snapshot_dir is None or manifest.get('version') != os.path.basename(snapshot_dir):
+        return None
+
+    stat = os.stat(source_path)
+    if manifest.get('path') != os.path.abspath(source_path) or manifest.get('size') != stat.st_size:
+        return None
+    if manifest.get('mtime') != stat.st_mtime:
+        if _file_sha256(source_path) != manifest.get('sha256'):
+            return None
+        manifest['mtime'] = stat.st_mtime
+        _write_json_atomic(manifest_path, manifest)
+    return snapshot_dir
+
+
+def build_source_cache(source_path):
+    """Read an Excel preset source into a fresh cached snapshot next to it.
+
+    The source is fingerprinted before it is read, so a change made while
+    reading is picked up by the next freshness check.
+    """
+    stat = os.stat(source_path)
+    fingerprint = {
+        'path': os.path.abspath(source_path),
+        'size': stat.st_size,
+        'mtime': stat.st_mtime,
+        'sha256': _file_sha256(source_path),
+    }
+    df, _ = read_preset_excel(source_path)
+    cache_root = source_cache_root(source_path)
+    fingerprint['version'] = publish_preset_snapshot(compact_preset_df(df), cache_root)
+    _write_json_atomic(os.path.join(cache_root, SOURCE_MANIFEST_NAME), fingerprint)
+    return current_snapshot_dir(cache_root)
+
+
+def open_source_cache(source_path):
+    """Return the snapshot directory for an Excel preset source, rebuilding it if stale."""
+    return cached_source_snapshot(source_path) or build_source_cache(source_path)
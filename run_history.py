@@ -0,0 +1,110 @@
+import json
+import sqlite3
+from datetime import datetime
+
+RUN_HISTORY_DB = "run_history.db"
+
+# Columns of the runs table, in order; JSON_COLUMNS are stored as JSON
+RUN_COLUMNS = {
+    'started_at': 'TEXT',
+    'status': 'TEXT',
+    'error': 'TEXT',
+    'preset_version': 'TEXT',
+    'mode': 'TEXT',
+    'plan_reason': 'TEXT',
+    'pim_bytes': 'INTEGER',
+    'part_data_bytes': 'INTEGER',
+    'pim_rows': 'INTEGER',
+    'filtered_rows': 'INTEGER',
+    'part_lookup_hits': 'INTEGER',
+    'preset_lookup_keys': 'INTEGER',
+    'preset_matches': 'INTEGER',
+    'duration_seconds': 'REAL',
+    'step_durations': 'TEXT',
+    'pim_header': 'TEXT',
+    'part_data_header': 'TEXT',
+}
+JSON_COLUMNS = ('step_durations', 'pim_header', 'part_data_header')
+
+
+def _connect(db_path):
+    conn = sqlite3.connect(db_path, timeout=30)
+    columns = ", ".join(f"{name} {sql_type}" for name, sql_type in RUN_COLUMNS.items())
+    conn.execute(f"CREATE TABLE IF NOT EXISTS runs (id INTEGER PRIMARY KEY AUTOINCREMENT, {columns})")
+    # Add columns introduced after the history file was created
+    existing = {row[1] for row in conn.execute("PRAGMA table_info(runs)")}
+    for name, sql_type in RUN_COLUMNS.items():
+        if name not in existing:
+            conn.execute(f"ALTER TABLE runs ADD COLUMN {name} {sql_type}")
+    return conn
+
+
+def new_run_record():
+    """Return an empty run record stamped with the current time."""
+    record = {name: None for name in RUN_COLUMNS}
+    record['started_at'] = datetime.now().isoformat(timespec='seconds')
+    record['step_durations'] = {}
+    return record
+
+
+def record_run(record, db_path=RUN_HISTORY_DB):
+    """Append one run record to the history store."""
+    values = dict(record)
+    values['step_durations'] = json.dumps(values.get('step_durations') or {})
+    for name in JSON_COLUMNS[1:]:
+        if values.get(name) is not None:
+            values[name] = json.dumps(values[name])
+    names = list(RUN_COLUMNS)
+    conn = _connect(db_path)
+    try:
+        with conn:
+            conn.execute(
+                f"INSERT INTO runs ({', '.join(names)}) VALUES ({', '.join('?' for _ in names)})",
+                [values.get(name) for name in names],
+            )
+    finally:
+        conn.close()
+
+
+def last_input_headers(db_path=RUN_HISTORY_DB):
+    """Return the PIM and Part Data header rows of the last successful run.
+
+    Returns a dict with 'pim_header' and 'part_data_header' lists, None for
+    inputs no successful run has recorded yet.
+    """
+    conn = _connect(db_path)
+    try:
+        headers = {}
+        for name in ('pim_header', 'part_data_header'):
+            row = conn.execute(
+                f"SELECT {name} FROM runs WHERE status = 'ok' AND {name} IS NOT NULL ORDER BY id DESC LIMIT 1"
+            ).fetchone()
+            headers[name] = json.loads(row[0]) if row else None
+        return headers
+    finally:
+        conn.close()
+
+
+def load_run_history(db_path=RUN_HISTORY_DB):
+    """Load all recorded runs as a DataFrame, oldest first.
+
+    Adds derived columns: part_lookup_hit_rate, rows_per_second and one
+    step_<name> column per recorded step duration.
+    """
+    import pandas as pd
+
+    conn = _connect(db_path)
+    try:
+        df = pd.read_sql_query("SELECT * FROM runs ORDER BY id", conn)
+    finally:
+        conn.close()
+
+    df['started_at'] = pd.to_datetime(df['started_at'])
+    filtered = df['filtered_rows'].where(df['filtered_rows'] > 0)
+    df['part_lookup_hit_rate'] = df['part_lookup_hits'] / filtered
+    duration = df['duration_seconds'].where(df['duration_seconds'] > 0)
+    df['rows_per_second'] = df['pim_rows'] / duration
+    steps = pd.DataFrame([json.loads(value or '{}') for value in df['step_durations']], index=df.index)
+    for step in steps.columns:
+        df[f"step_{step}"] = steps[step]
+    return df
@@ -0,0 +1,166 @@
+import os
+import re
+import sys
+import zipfile
+from datetime import date, datetime
+
+import pandas as pd
+import pytest
+from openpyxl import Workbook
+from openpyxl.styles import PatternFill
+
+# The modules live flat at the repository root
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+PIM_HEADER = [
+    "Site", "Region", "Part No", "Variant", "Created", "Changed", "Owner", "Status",
+    "Comment", "Team", "Ref", "Supplier", "Supplier Part", "Old Value", "New Value",
+    "Source", "Notes", "Extra 1", "Extra 2", "Extra 3",
+]
+
+
+# Cells written as "100.0" rather than "100", so they read back as floats
+# equal to ints, as Excel files from other writers can hold them
+PIM_FLOAT_CELLS = {"D3": "100.0", "C5": "5.0", "D5": "7.0"}
+
+
+def rewrite_sheet_xml(path, edit, sheet_path="xl/worksheets/sheet1.xml"):
+    """Replace a worksheet's XML in an xlsx file by edit(xml_bytes)."""
+    with zipfile.ZipFile(path) as zf:
+        members = [(info, zf.read(info)) for info in zf.infolist()]
+    with zipfile.ZipFile(path, 'w', compression=zipfile.ZIP_DEFLATED) as zf:
+        for info, data in members:
+            zf.writestr(info, edit(data) if info.filename == sheet_path else data)
+
+
+def stale_dimension(xml):
+    """Rewrite a sheet's dimension tag to "A1", as some writers leave it."""
+    return re.sub(rb'<dimension ref="[^"]*"', b'<dimension ref="A1"', xml)
+
+
+def write_float_cells(xml, cells):
+    """Set the number text of the given cells, e.g. {"D3": "100.0"}."""
+    for ref, text in cells.items():
+        xml, count = re.subn(rf'(<c r="{ref}"[^>]*><v>)[^<]*(</v>)'.encode(), rb'\g<1>' + text.encode() + rb'\2', xml)
+        assert count == 1, ref
+    return xml
+
+
+def pim_rows():
+    """PIM data rows with the values the engines must treat alike.
+
+    Column C/D form the preset key, H selects the rows and L/M the part
+    data key; the rows mix dates, bools, floats equal to ints (see
+    PIM_FLOAT_CELLS) and blank keys.
+    """
+    rows = [
+        ["S1", "EU", "A1", 100, datetime(2024, 1, 5), date(2024, 2, 1), "amy", "New",
+         None, "T1", 1, "SUP", "X1", "old", "new", "src", "n", "e1", "e2", "e3"],
+        ["S1", "EU", "A1", 100, datetime(2024, 1, 5, 8, 30), None, "bob", "check updates",
+         "c", "T1", 2, "SUP", "X2", 1.5, 2, None, None, None, None, "e3"],
+        ["S2", "US", 5, 7, None, None, "cy", "Check Value now",
+         None, None, 3, "SUP", "X1", None, None, None, None, None, None, None],
+        ["S2", "US", 5, 7, None, None, "cy", "NEW part",
+         None, None, 4, None, None, date(2023, 12, 31), True, None, None, None, None, None],
+        ["S3", None, None, None, None, None, "dee", "new",
+         None, None, 5, None, None, None, None, None, None, None, None, None],
+        ["S3", None, None, "B2", None, None, "dee", "New",
+         None, None, 6, "SUP", None, None, None, None, None, None, None, None],
+        ["S4", "APAC", True, False, None, None, "eve", "new",
+         None, None, 7, 0, "X3", None, None, None, None, None, None, None],
+        ["S4", "APAC", 1, None, None, None, "eve", "check value",
+         None, None, 8, "SUP", "X2", None, None, None, None, None, None, None],
+        ["S5", "EU", "A1", 100, None, None, "fay", "Done",
+         None, None, 9, "SUP", "X1", None, None, None, None, None, None, None],
+        ["S5", "EU", "C3", 2.5, None, None, "fay", None,
+         None, None, 10, None, None, None, None, None, None, None, None, None],
+        ["S6", "EU", "C3", 2.5, None, None, "gus", True,
+         None, None, 11, None, None, None, None, None, None, None, None, None],
+        ["S6", "EU", "A1", 100, None, None, "gus", 0,
+         None, None, 12, "SUP", "X9", None, None, None, None, None, None, None],
+    ]
+    return rows
+
+
+def add_rows_without_cells(xml, count):
+    """Append count <row> elements without cells and stretch the dimension over them.
+
+    Other writers leave such rows behind; only the read-only engines see them.
+    """
+    last_row = max(int(row) for row in re.findall(rb'<row r="(\d+)"', xml))
+    empty_rows = b"".join(b'<row r="%d"/>' % (last_row + offset) for offset in range(1, count + 1))
+    xml = xml.replace(b"</sheetData>", empty_rows + b"</sheetData>")
+    return re.sub(rb'(<dimension ref="A1:[A-Z]+)\d+', rb'\g<1>%d' % (last_row + count), xml)
+
+
+def write_pim_file(path, rows=None, trailing_empty_rows=4):
+    """Write a PIM report ending in empty rows.
+
+    Half of the trailing_empty_rows hold only empty, styled cells; the rest
+    are <row> elements without cells.
+    """
+    wb = Workbook()
+    ws = wb.active
+    ws.title = "PIM Issues"
+    ws.append(PIM_HEADER)
+    for row in pim_rows() if rows is None else rows:
+        ws.append(row)
+    styled_rows = trailing_empty_rows // 2
+    for offset in range(styled_rows):
+        cell = ws.cell(row=ws.max_row + 1, column=offset + 1)
+        cell.fill = PatternFill(start_color="FFFF00", end_color="FFFF00", fill_type="solid")
+    wb.save(path)
+
+    def edit(xml):
+        if rows is None:
+            xml = write_float_cells(xml, PIM_FLOAT_CELLS)
+        return add_rows_without_cells(xml, trailing_empty_rows - styled_rows)
+
+    rewrite_sheet_xml(path, edit)
+    return path
+
+
+def write_part_data_file(path):
+    """Write a Part Data file keyed by C & D with the Datasheet values in P and R."""
+    wb = Workbook()
+    ws = wb.active
+    ws.append([f"Col {col_idx}" for col_idx in range(1, 19)])
+
+    def part_row(c_val, d_val, p_val, r_val):
+        row = [None] * 18
+        row[2], row[3], row[15], row[17] = c_val, d_val, p_val, r_val
+        return row
+
+    ws.append(part_row("SUP", "X1", "DS-1", "unused"))
+    ws.append(part_row("SUP", "X2", "see NOD sheet", "DS-2"))
+    ws.append(part_row("0", "X3", 42, None))
+    ws.append(part_row(None, None, "no key", None))
+    wb.save(path)
+    return path
+
+
+def preset_dataframe():
+    """Preset rows keyed by column E, matching some of the PIM C & D keys."""
+    return pd.DataFrame({
+        "Brand": ["b1", "b2", "b3", "b4", "b5"],
+        "Model": ["m1", "m2", "m3", "m4", "m5"],
+        "Line": [1, 2, 3, 4, 5],
+        "Description": ["first", "second", "third", "fourth", "fifth"],
+        "Key": ["A1100", "57", "A1100.0", "B2", "missing"],
+        "Value": [1.5, 2.0, None, 4.25, 5.0],
+        "Valid From": pd.to_datetime(["2024-01-01", "2024-02-01", "2024-03-01", "2024-04-01", "2024-05-01"]),
+    })
+
+
+@pytest.fixture
+def pipeline_inputs(tmp_path):
+    """Paths of a PIM report, a Part Data file and a preset store built from them."""
+    from preset_store import write_preset_store
+
+    preset_dir = str(tmp_path / "preset")
+    write_preset_store(preset_dataframe(), preset_dir)
+    return {
+        'pim': write_pim_file(str(tmp_path / "pim.xlsx")),
+        'part_data': write_part_data_file(str(tmp_path / "part_data.xlsx")),
+        'preset_dir': preset_dir,
+    }
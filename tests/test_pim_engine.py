@@ -0,0 +1,145 @@
+import pandas as pd
+import pytest
+from openpyxl import load_workbook
+
+import pim_engine
+from conftest import preset_dataframe, rewrite_sheet_xml, stale_dimension
+from pim_engine import (
+    run_pipeline, _run_streaming, write_preset_output,
+    MODE_AUTO, MODE_IN_MEMORY, MODE_COLUMNAR, MODE_STREAMING,
+)
+from preset_store import build_preset_index, lookup_preset_index
+
+STAT_KEYS = ['pim_rows', 'filtered_rows', 'part_lookup_hits', 'preset_lookup_keys', 'preset_matches']
+
+
+def sheet_values(path):
+    """Return the first sheet of a workbook as lists of cell values."""
+    wb = load_workbook(path)
+    try:
+        return [list(row) for row in wb.worksheets[0].iter_rows(values_only=True)]
+    finally:
+        wb.close()
+
+
+def run_engine(inputs, output, mode):
+    index = build_preset_index(inputs['preset_dir'])
+    return run_pipeline(
+        inputs['pim'], inputs['part_data'],
+        lambda lookup_values: lookup_preset_index(index, lookup_values),
+        output, mode=mode,
+    )
+
+
+@pytest.fixture
+def in_memory_result(pipeline_inputs, tmp_path):
+    output = str(tmp_path / "in_memory.xlsx")
+    matched_rows, stats = run_engine(pipeline_inputs, output, MODE_IN_MEMORY)
+    return sheet_values(output), matched_rows, stats
+
+
+@pytest.mark.parametrize('mode', [MODE_COLUMNAR, MODE_STREAMING])
+def test_engines_match_in_memory_output(pipeline_inputs, tmp_path, in_memory_result, mode):
+    expected_values, expected_rows, expected_stats = in_memory_result
+    output = str(tmp_path / f"{mode}.xlsx")
+    matched_rows, stats = run_engine(pipeline_inputs, output, mode)
+
+    assert sheet_values(output) == expected_values
+    pd.testing.assert_frame_equal(matched_rows, expected_rows)
+    assert {key: stats[key] for key in STAT_KEYS} == {key: expected_stats[key] for key in STAT_KEYS}
+
+
+@pytest.mark.parametrize('mode', [MODE_COLUMNAR, MODE_STREAMING])
+def test_engines_ignore_a_stale_dimension(pipeline_inputs, tmp_path, in_memory_result, mode):
+    """A PIM sheet whose dimension tag says "A1" is still read in full."""
+    expected_values, expected_rows, expected_stats = in_memory_result
+    rewrite_sheet_xml(pipeline_inputs['pim'], stale_dimension)
+    output = str(tmp_path / f"{mode}_stale.xlsx")
+    matched_rows, stats = run_engine(pipeline_inputs, output, mode)
+
+    assert sheet_values(output) == expected_values
+    pd.testing.assert_frame_equal(matched_rows, expected_rows)
+    assert {key: stats[key] for key in STAT_KEYS} == {key: expected_stats[key] for key in STAT_KEYS}
+
+
+@pytest.mark.parametrize('mode', [MODE_IN_MEMORY, MODE_COLUMNAR, MODE_STREAMING])
+def test_part_data_with_a_stale_dimension_is_read_in_full(pipeline_inputs, tmp_path, in_memory_result, mode):
+    """Every engine finds the Datasheet values of a Part Data sheet whose dimension tag says "A1"."""
+    expected_values, expected_rows, expected_stats = in_memory_result
+    rewrite_sheet_xml(pipeline_inputs['part_data'], stale_dimension)
+    output = str(tmp_path / f"{mode}_stale_part.xlsx")
+    matched_rows, stats = run_engine(pipeline_inputs, output, mode)
+
+    assert stats['part_lookup_hits'] == expected_stats['part_lookup_hits'] > 0
+    assert sheet_values(output) == expected_values
+
+
+@pytest.mark.parametrize('budget_mb, mode', [(1024, MODE_COLUMNAR), (1, MODE_STREAMING)])
+def test_auto_plan_of_a_stale_dimension_keeps_every_row(
+        pipeline_inputs, tmp_path, in_memory_result, monkeypatch, budget_mb, mode):
+    """Auto mode sends a stale-dimension report off the in-memory engine without losing rows."""
+    expected_values, expected_rows, expected_stats = in_memory_result
+    rewrite_sheet_xml(pipeline_inputs['pim'], stale_dimension)
+    # Make the small fixture look large enough for the planner to leave in-memory
+    monkeypatch.setattr(pim_engine, 'PLAN_BYTES_PER_CELL', {MODE_IN_MEMORY: 10 ** 9, MODE_COLUMNAR: 10 ** 6})
+    index = build_preset_index(pipeline_inputs['preset_dir'])
+    output = str(tmp_path / "auto.xlsx")
+    matched_rows, stats = run_pipeline(
+        pipeline_inputs['pim'], pipeline_inputs['part_data'],
+        lambda lookup_values: lookup_preset_index(index, lookup_values),
+        output, mode=MODE_AUTO, budget_mb=budget_mb,
+    )
+
+    assert stats['mode'] == mode
+    # The planner sizes the sheet from its tags, including the two rows without cells
+    assert stats['plan_estimates']['pim_rows'] == len(expected_values) + 2
+    assert sheet_values(output) == expected_values
+    pd.testing.assert_frame_equal(matched_rows, expected_rows)
+    assert stats['pim_rows'] == expected_stats['pim_rows'] and stats['filtered_rows'] == expected_stats['filtered_rows']
+
+
+def test_streaming_batches_match_in_memory_output(pipeline_inputs, tmp_path, in_memory_result):
+    """Batches smaller than the sheet spill and write the same rows."""
+    expected_values = in_memory_result[0]
+    index = build_preset_index(pipeline_inputs['preset_dir'])
+    output = str(tmp_path / "streaming_batches.xlsx")
+    _run_streaming(
+        pipeline_inputs['pim'], pipeline_inputs['part_data'],
+        lambda lookup_values: lookup_preset_index(index, lookup_values),
+        output, lambda message: None, lambda value: None, batch_rows=3,
+    )
+    assert sheet_values(output) == expected_values
+
+
+def test_in_memory_output_covers_the_edge_cases(in_memory_result):
+    """Guard the fixture: the comparison above must see the cases it is meant to."""
+    values, matched_rows, stats = in_memory_result
+    header = values[0]
+    assert header[15] == 'XXXXX' and header[20] == 'Datasheet'
+    assert stats['filtered_rows'] == 8
+    # Keys from 100 and 100.0 stay distinct; the blank C & D row has no key
+    assert sorted(matched_rows['Key']) == ['57', 'A1100', 'A1100.0', 'B2']
+    # Trailing rows with styled empty cells are part of the sheet, rows without cells are not
+    assert len(values) == 15 and not any(any(row) for row in values[-2:])
+    # 5 and 5.0, and 1 and True, count as the same column C value
+    counts_s = {row[2]: row[17] for row in values[1:] if row[17] is not None}
+    assert counts_s[5] == 2 and counts_s[True] == 2
+
+
+def test_preset_output_matches_to_excel(tmp_path):
+    """The streamed DK Preset workbook holds the values DataFrame.to_excel writes."""
+    preset_rows = preset_dataframe()
+    preset_rows.loc[1, 'Value'] = float('inf')
+    preset_rows['Flag'] = [True, False, None, True, False]
+    expected = str(tmp_path / "to_excel.xlsx")
+    preset_rows.to_excel(expected, index=False)
+    output = str(tmp_path / "preset.xlsx")
+    write_preset_output(preset_rows, output, batch_rows=2)
+
+    assert sheet_values(output) == sheet_values(expected)
+    wb = load_workbook(output)
+    ws = wb.active
+    assert ws['D1'].fill.fgColor.rgb == '0000B050' and ws['F1'].fill.fgColor.rgb == '0000B0F0'
+    assert ws['A2'].font.color.rgb == '00000000' and ws['G2'].number_format == 'YYYY-MM-DD HH:MM:SS'
+    assert ws.auto_filter.ref == 'A1:H6' and ws.column_dimensions['E'].width == 80
+    wb.close()
@@ -0,0 +1,106 @@
+import json
+import os
+import threading
+import time
+from urllib.error import HTTPError
+from urllib.request import Request, urlopen
+
+import pytest
+
+import pim_service
+from conftest import preset_dataframe, write_part_data_file, write_pim_file
+from preset_store import publish_preset_snapshot
+
+
+@pytest.fixture
+def service_url(tmp_path):
+    """URL of a service on a free localhost port with one worker and a queue of one job."""
+    preset_store_dir = str(tmp_path / "preset_store")
+    publish_preset_snapshot(preset_dataframe(), preset_store_dir)
+    server = pim_service.make_server(
+        port=0, workers=1, queue_size=1,
+        preset_store_dir=preset_store_dir, history_db=str(tmp_path / "history.db"),
+    )
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    try:
+        yield f"http://127.0.0.1:{server.server_address[1]}"
+    finally:
+        server.shutdown()
+        server.server_close()
+        pim_service.close_service(server.service)
+
+
+def request(url, payload=None):
+    """Send a GET, or a POST of payload as JSON; returns (status, body)."""
+    data = None if payload is None else json.dumps(payload).encode()
+    try:
+        with urlopen(Request(url, data=data, headers={"Content-Type": "application/json"})) as response:
+            return response.status, json.loads(response.read())
+    except HTTPError as e:
+        return e.code, json.loads(e.read())
+
+
+def wait_for_job(url, job_id, timeout=10):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        status, job = request(f"{url}/jobs/{job_id}")
+        if job['state'] in ('done', 'error'):
+            return job
+        time.sleep(0.05)
+    raise AssertionError(f"Job {job_id} still {job['state']} after {timeout} s")
+
+
+def job_payload(tmp_path, name):
+    pim = write_pim_file(str(tmp_path / f"{name}_pim.xlsx"))
+    part_data = write_part_data_file(str(tmp_path / f"{name}_part_data.xlsx"))
+    return {'pim_file_path': pim, 'part_data_file_path': part_data, 'force': True}
+
+
+def test_job_runs_and_frees_its_slot(service_url, tmp_path):
+    for name in ("first", "second"):
+        status, body = request(f"{service_url}/jobs", job_payload(tmp_path, name))
+        assert status == 202, body
+        job = wait_for_job(service_url, body['id'])
+        assert job['state'] == 'done', job
+        assert job['stats']['filtered_rows'] == 8
+
+
+@pytest.fixture
+def worker_gate(monkeypatch):
+    """An Event that jobs wait on before running their pipeline; set it to let them run."""
+    gate = threading.Event()
+    run_pipeline = pim_service.run_pipeline
+
+    def gated_run_pipeline(*args, **kwargs):
+        assert gate.wait(10)
+        return run_pipeline(*args, **kwargs)
+
+    monkeypatch.setattr(pim_service, 'run_pipeline', gated_run_pipeline)
+    return gate
+
+
+def submit(url, payload):
+    status, body = request(f"{url}/jobs", payload)
+    assert status == 202, body
+    return body['id']
+
+
+def test_input_removed_while_queued_fails_the_job_and_frees_its_slot(service_url, tmp_path, worker_gate):
+    running = submit(service_url, job_payload(tmp_path, "running"))
+    queued_payload = job_payload(tmp_path, "queued")
+    queued = submit(service_url, queued_payload)
+    os.remove(queued_payload['pim_file_path'])
+    worker_gate.set()
+
+    assert wait_for_job(service_url, running)['state'] == 'done'
+    job = wait_for_job(service_url, queued)
+    assert job['state'] == 'error' and "No such file" in job['error']
+
+    # Both slots are free again: one job runs, one queues, the next is turned away
+    worker_gate.clear()
+    jobs = [submit(service_url, job_payload(tmp_path, name)) for name in ("third", "fourth")]
+    status, body = request(f"{service_url}/jobs", job_payload(tmp_path, "fifth"))
+    assert status == 503, body
+    worker_gate.set()
+    assert [wait_for_job(service_url, job_id)['state'] for job_id in jobs] == ['done', 'done']
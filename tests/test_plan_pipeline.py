@@ -0,0 +1,118 @@
+import re
+
+import pytest
+from openpyxl import Workbook
+
+import xlsx_inspect
+from conftest import rewrite_sheet_xml, stale_dimension
+from pim_engine import (
+    plan_pipeline, MODE_IN_MEMORY, MODE_COLUMNAR, MODE_STREAMING,
+)
+from preflight import check_part_data_file
+from xlsx_inspect import sheet_dimension, inspect_workbook
+
+ROWS, COLS = 40, 6
+
+
+@pytest.fixture
+def sheet_file(tmp_path):
+    """A ROWS x COLS sheet with every cell filled."""
+    path = str(tmp_path / "sheet.xlsx")
+    wb = Workbook()
+    ws = wb.active
+    ws.append([f"Head {col_idx}" for col_idx in range(1, COLS + 1)])
+    for row_idx in range(2, ROWS + 1):
+        ws.append([row_idx * 100 + col_idx for col_idx in range(1, COLS + 1)])
+    wb.save(path)
+    return path
+
+
+def test_sheet_dimension_reads_the_dimension_tag(sheet_file):
+    size = sheet_dimension(sheet_file)
+    assert (size['rows'], size['cols'], size['cells']) == (ROWS, COLS, ROWS * COLS)
+
+
+def test_sheet_without_dimension_tag_is_sized_from_its_tags(sheet_file):
+    rewrite_sheet_xml(sheet_file, lambda xml: re.sub(rb'<dimension [^>]*/>', b'', xml))
+    size = sheet_dimension(sheet_file)
+    assert (size['rows'], size['cols']) == (ROWS, COLS)
+    assert inspect_workbook(sheet_file)['header'] == [f"Head {col_idx}" for col_idx in range(1, COLS + 1)]
+
+
+def test_stale_a1_dimension_is_sized_from_its_tags(sheet_file):
+    rewrite_sheet_xml(sheet_file, stale_dimension)
+    size = sheet_dimension(sheet_file)
+    assert (size['rows'], size['cols']) == (ROWS, COLS)
+
+
+def test_stale_dimension_of_a_sparse_sheet_reports_its_last_column(tmp_path):
+    """cols is the last column any cell uses, not the average row width."""
+    path = str(tmp_path / "sparse_part_data.xlsx")
+    wb = Workbook()
+    ws = wb.active
+    ws.append([f"Col {col_idx}" for col_idx in range(1, 19)])
+    for row_idx in range(30):
+        row = [None] * 18
+        row[2], row[3] = "SUP", f"X{row_idx}"
+        if row_idx % 10 == 0:
+            row[15], row[17] = "DS", "NOD"
+        ws.append(row)
+    wb.save(path)
+    rewrite_sheet_xml(path, stale_dimension)
+
+    size = sheet_dimension(path)
+    assert (size['rows'], size['cols']) == (31, 18)
+    # The cells actually written, for the planner's memory estimates
+    assert size['cells'] == 18 + 30 * 2 + 3 * 2
+    assert check_part_data_file(path)['errors'] == []
+
+
+def test_small_input_plans_in_memory(sheet_file):
+    plan = plan_pipeline(sheet_file, sheet_file, budget_mb=1024)
+    assert plan['mode'] == MODE_IN_MEMORY
+    assert plan['estimates']['pim_cells'] == ROWS * COLS
+
+
+def test_unreadable_input_falls_back_to_in_memory(tmp_path, sheet_file):
+    not_xlsx = tmp_path / "not.xlsx"
+    not_xlsx.write_bytes(b"not a zip file")
+    plan = plan_pipeline(str(not_xlsx), sheet_file, budget_mb=1024)
+    assert plan['mode'] == MODE_IN_MEMORY
+    assert "could not be read" in plan['reason']
+
+
+def fake_dimensions(monkeypatch, pim_rows, pim_cols, part_rows=1000):
+    """Make plan_pipeline see inputs of the given sizes."""
+    sizes = {
+        'pim': {'bytes': 1, 'xml_bytes': 1, 'rows': pim_rows, 'cols': pim_cols, 'cells': pim_rows * pim_cols},
+        'part': {'bytes': 1, 'xml_bytes': 1, 'rows': part_rows, 'cols': 18, 'cells': part_rows * 18},
+    }
+    monkeypatch.setattr(xlsx_inspect, 'sheet_dimension', lambda source: sizes[source])
+
+
+def estimated_mb(monkeypatch, pim_rows, pim_cols):
+    fake_dimensions(monkeypatch, pim_rows, pim_cols)
+    return plan_pipeline('pim', 'part', budget_mb=10 ** 9)['estimates']['estimated_mb']
+
+
+def test_plan_boundaries_follow_the_budget(monkeypatch):
+    rows, cols = 12_500, 40
+    estimates = estimated_mb(monkeypatch, rows, cols)
+    in_memory_mb, columnar_mb = estimates[MODE_IN_MEMORY], estimates[MODE_COLUMNAR]
+    assert columnar_mb < in_memory_mb
+
+    for budget_mb, mode in [
+        (in_memory_mb, MODE_IN_MEMORY),
+        (in_memory_mb - 0.1, MODE_COLUMNAR),
+        (columnar_mb, MODE_COLUMNAR),
+        (columnar_mb - 0.1, MODE_STREAMING),
+    ]:
+        assert plan_pipeline('pim', 'part', budget_mb=budget_mb)['mode'] == mode, budget_mb
+
+
+def test_large_report_within_the_budget_stays_in_memory(monkeypatch):
+    """Only the budget moves a report off the engine that keeps its styles and other sheets."""
+    fake_dimensions(monkeypatch, 100_000, 20)
+    plan = plan_pipeline('pim', 'part', budget_mb=10 ** 9)
+    assert plan['estimates']['pim_cells'] == 2_000_000
+    assert plan['mode'] == MODE_IN_MEMORY
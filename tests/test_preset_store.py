@@ -0,0 +1,103 @@
+import os
+import time
+
+import pandas as pd
+
+import preset_store
+from conftest import preset_dataframe
+from preset_store import (
+    publish_preset_snapshot, rollback_preset_snapshot, deactivate_preset_snapshots, gc_preset_snapshots,
+    list_preset_snapshots, current_snapshot_version, current_snapshot_dir, previous_snapshot_version,
+    cached_preset_index, get_preset_index, load_preset_rows, lookup_preset_snapshot,
+)
+
+LOOKUP_KEYS = ["A1100", "B2", "not a key", "57"]
+# Short enough to wait out in a test
+RETENTION_SECONDS = 1
+
+
+def publish(root, label):
+    """Publish the preset fixture with every Brand set to label."""
+    return publish_preset_snapshot(preset_dataframe().assign(Brand=label), root, retention_seconds=RETENTION_SECONDS)
+
+
+def current_label(root):
+    """Return the Brand label of the current snapshot, or None without one."""
+    snapshot_dir = current_snapshot_dir(root)
+    if snapshot_dir is None:
+        return None
+    return load_preset_rows(snapshot_dir, ["B2"])['Brand'].iloc[0]
+
+
+def wait_out_retention():
+    time.sleep(RETENTION_SECONDS + 0.2)
+
+
+def test_superseded_snapshots_are_collected_after_retention(tmp_path):
+    root = str(tmp_path / "store")
+    first, second, third = publish(root, "v1"), publish(root, "v2"), publish(root, "v3")
+    assert list_preset_snapshots(root) == [first, second, third]
+    assert (current_snapshot_version(root), current_label(root)) == (third, "v3")
+
+    # Retention runs from when a snapshot was superseded, not from its directory's age
+    os.utime(os.path.join(root, preset_store.SNAPSHOTS_DIR, first), (0, 0))
+    assert gc_preset_snapshots(root, RETENTION_SECONDS) == []
+
+    wait_out_retention()
+    # The rollback target is kept however long ago it was superseded
+    assert gc_preset_snapshots(root, RETENTION_SECONDS) == [first]
+    assert list_preset_snapshots(root) == [second, third]
+    assert set(preset_store._read_superseded_log(root)) == {second}
+
+
+def test_rollback_restores_the_previous_snapshot(tmp_path):
+    root = str(tmp_path / "store")
+    first, second = publish(root, "v1"), publish(root, "v2")
+
+    assert rollback_preset_snapshot(root) == first
+    assert (current_snapshot_version(root), current_label(root)) == (first, "v1")
+    # Nothing older to go back to
+    assert rollback_preset_snapshot(root) is None
+    assert current_snapshot_version(root) == first
+
+    # The rolled-back snapshot is superseded now and kept for the retention window only
+    assert gc_preset_snapshots(root, RETENTION_SECONDS) == []
+    wait_out_retention()
+    assert gc_preset_snapshots(root, RETENTION_SECONDS) == [second]
+    assert list_preset_snapshots(root) == [first]
+
+
+def test_deactivated_database_can_be_rolled_back_until_retention_ends(tmp_path):
+    root = str(tmp_path / "store")
+    first, second = publish(root, "v1"), publish(root, "v2")
+
+    deactivate_preset_snapshots(root, RETENTION_SECONDS)
+    assert current_snapshot_version(root) is None and current_label(root) is None
+    assert list_preset_snapshots(root) == [first, second]
+    assert previous_snapshot_version(root) == second
+    assert rollback_preset_snapshot(root) == second
+    assert current_label(root) == "v2"
+
+    deactivate_preset_snapshots(root, RETENTION_SECONDS)
+    wait_out_retention()
+    assert sorted(gc_preset_snapshots(root, RETENTION_SECONDS)) == [first, second]
+    assert rollback_preset_snapshot(root) is None
+
+
+def test_cold_lookup_reads_shards_without_building_the_index(tmp_path, monkeypatch):
+    root = str(tmp_path / "store")
+    publish_preset_snapshot(preset_dataframe(), root)
+    snapshot_dir = current_snapshot_dir(root)
+
+    def no_index(store_dir):
+        raise AssertionError("a cold lookup must not load the whole key index")
+
+    with monkeypatch.context() as patch:
+        patch.setattr(preset_store, 'build_preset_index', no_index)
+        cold_rows = lookup_preset_snapshot(snapshot_dir, LOOKUP_KEYS)
+    assert cached_preset_index(snapshot_dir) is None
+
+    get_preset_index(snapshot_dir)
+    warm_rows = lookup_preset_snapshot(snapshot_dir, LOOKUP_KEYS)
+    pd.testing.assert_frame_equal(cold_rows, warm_rows)
+    assert sorted(cold_rows['Key']) == ["57", "A1100", "B2"]
@@ -0,0 +1,251 @@
+import os
+import posixpath
+import re
+import zipfile
+from xml.etree import ElementTree
+
+from openpyxl.utils.cell import column_index_from_string, coordinate_from_string, range_boundaries
+
+# Bytes of the sheet XML read when looking for the <dimension> tag,
+# which Excel writes before the sheet data
+DIMENSION_SCAN_BYTES = 64 * 1024
+# Sheet XML is scanned in chunks of this size when it has no dimension tag
+XML_SCAN_CHUNK_BYTES = 1024 * 1024
+# A dimension implying more sheet XML per cell than this is stale (some
+# writers always report "A1")
+MAX_XML_BYTES_PER_CELL = 1000
+
+_DIMENSION_RE = re.compile(rb'<(?:\w+:)?dimension\s+ref="([^"]+)"')
+_CELL_COLUMN_RE = re.compile(rb'<c r="([A-Z]+)\d')
+_REL_NS = "http://schemas.openxmlformats.org/officeDocument/2006/relationships"
+_MAIN_NS = "http://schemas.openxmlformats.org/spreadsheetml/2006/main"
+_PKG_REL_NS = "http://schemas.openxmlformats.org/package/2006/relationships"
+
+
+def source_size(source):
+    """Return the size in bytes of a path or seekable binary file object."""
+    if isinstance(source, (str, os.PathLike)):
+        return os.path.getsize(source)
+    position = source.tell()
+    size = source.seek(0, os.SEEK_END)
+    source.seek(position)
+    return size
+
+
+def _workbook_targets(zf):
+    """Return the workbook's relationship ids and types mapped to zip member names."""
+    rels = ElementTree.fromstring(zf.read("xl/_rels/workbook.xml.rels"))
+    targets = {}
+    for rel in rels.iter(f"{{{_PKG_REL_NS}}}Relationship"):
+        target = rel.get("Target")
+        if target.startswith("/"):
+            path = target.lstrip("/")
+        else:
+            path = posixpath.normpath(posixpath.join("xl", target))
+        targets[rel.get("Id")] = (rel.get("Type").rsplit("/", 1)[-1], path)
+    return targets
+
+
+def first_sheet_path(zf):
+    """Return the zip member name of the workbook's first worksheet."""
+    workbook = ElementTree.fromstring(zf.read("xl/workbook.xml"))
+    sheet = workbook.find(f"{{{_MAIN_NS}}}sheets/{{{_MAIN_NS}}}sheet")
+    if sheet is None:
+        raise ValueError("The workbook has no sheets")
+    rel_id = sheet.get(f"{{{_REL_NS}}}id")
+    targets = _workbook_targets(zf)
+    if rel_id not in targets:
+        raise ValueError(f"Sheet relationship {rel_id} not found")
+    return targets[rel_id][1]
+
+
+def _count_sheet_tags(sheet_xml):
+    """Count the <row> and <c> tags of a sheet XML stream without parsing it.
+
+    Returns (rows, cells, max_col); max_col is the largest column of the
+    cell references, 0 if the cells have none.
+    """
+    rows = cells = max_col = 0
+    tail = b""
+    while True:
+        chunk = sheet_xml.read(XML_SCAN_CHUNK_BYTES)
+        data = tail + chunk
+        # A tag cut off at the chunk end is scanned with the next chunk
+        cut = data.rfind(b"<") if chunk else -1
+        data, tail = (data[:cut], data[cut:]) if cut >= 0 else (data, b"")
+        rows += data.count(b"<row ")
+        cells += data.count(b"<c ")
+        letters = _CELL_COLUMN_RE.findall(data)
+        if letters:
+            # Column letters of the same length sort like their column numbers
+            longest = max(map(len, letters))
+            last = max(col for col in letters if len(col) == longest)
+            max_col = max(max_col, column_index_from_string(last.decode()))
+        if not chunk:
+            return rows, cells, max_col
+
+
+def _sheet_contains(zf, sheet_path, words):
+    """Return True if the lowercased sheet XML contains any of words."""
+    words = [word.lower().encode() for word in words]
+    overlap = max(len(word) for word in words) - 1
+    tail = b""
+    with zf.open(sheet_path) as sheet_xml:
+        while True:
+            chunk = sheet_xml.read(XML_SCAN_CHUNK_BYTES)
+            if not chunk:
+                return False
+            data = tail + chunk.lower()
+            if any(word in data for word in words):
+                return True
+            tail = data[-overlap:] if overlap else b""
+
+
+def _sheet_size(zf, sheet_path):
+    """Return (rows, cols, cells, xml_bytes) of a worksheet from its dimension tag.
+
+    Sheets whose writer left the tag out, or left it stale, are sized by
+    scanning their row and cell tags instead: cols is then the last column
+    any cell refers to and cells the number of cells actually written.
+    """
+    xml_bytes = zf.getinfo(sheet_path).file_size
+    with zf.open(sheet_path) as sheet_xml:
+        match = _DIMENSION_RE.search(sheet_xml.read(DIMENSION_SCAN_BYTES))
+    rows = cols = None
+    if match:
+        min_col, min_row, max_col, max_row = range_boundaries(match.group(1).decode())
+        if max_row is not None and max_col is not None:
+            rows, cols = max_row, max_col
+    if rows is None or rows * cols * MAX_XML_BYTES_PER_CELL < xml_bytes:
+        with zf.open(sheet_path) as sheet_xml:
+            rows, cells, cols = _count_sheet_tags(sheet_xml)
+        if not cols:
+            # Cells without references: the average row width is the best guess
+            cols = -(-cells // rows) if rows else 0
+        return rows, cols, cells, xml_bytes
+    return rows, cols, rows * cols, xml_bytes
+
+
+def read_shared_strings(zf):
+    """Return the workbook's shared strings as a list (empty if it has none)."""
+    paths = [path for rel_type, path in _workbook_targets(zf).values() if rel_type == "sharedStrings"]
+    if not paths:
+        return []
+    text_tag = f"{{{_MAIN_NS}}}t"
+    run_tag = f"{{{_MAIN_NS}}}r"
+    shared_strings = []
+    with zf.open(paths[0]) as sst_xml:
+        for event, elem in ElementTree.iterparse(sst_xml):
+            if elem.tag != f"{{{_MAIN_NS}}}si":
+                continue
+            # Plain strings have one <t>; rich text has one per run. Phonetic
+            # <rPh> runs are not part of the value.
+            text = elem.find(text_tag)
+            if text is not None:
+                shared_strings.append(text.text or "")
+            else:
+                shared_strings.append("".join(
+                    run.findtext(text_tag, default="") for run in elem.iter(run_tag)
+                ))
+            elem.clear()
+    return shared_strings
+
+
+def read_header_row(zf, sheet_path, shared_strings):
+    """Return the first row of a worksheet as strings, None for empty cells.
+
+    Only the start of the sheet XML is parsed.
+    """
+    cell_tag = f"{{{_MAIN_NS}}}c"
+    row_tag = f"{{{_MAIN_NS}}}row"
+    header = []
+    with zf.open(sheet_path) as sheet_xml:
+        for event, elem in ElementTree.iterparse(sheet_xml):
+            if elem.tag == row_tag:
+                break
+            if elem.tag != cell_tag:
+                continue
+            ref = elem.get("r")
+            col_idx = column_index_from_string(coordinate_from_string(ref)[0]) if ref else len(header) + 1
+            cell_type = elem.get("t", "n")
+            if cell_type == "inlineStr":
+                value = "".join(t.text or "" for t in elem.iter(f"{{{_MAIN_NS}}}t"))
+            else:
+                value = elem.findtext(f"{{{_MAIN_NS}}}v")
+                if value is not None and cell_type == "s":
+                    value = shared_strings[int(value)]
+                elif value is not None and cell_type == "b":
+                    value = str(value == "1")
+            header += [None] * (col_idx - len(header))
+            header[col_idx - 1] = value if value != "" else None
+    while header and header[-1] is None:
+        header.pop()
+    return header
+
+
+def _open_source(source, inspect):
+    """Run inspect(zf) on the xlsx zip of a path or file object, keeping its position."""
+    position = None if isinstance(source, (str, os.PathLike)) else source.tell()
+    try:
+        with zipfile.ZipFile(source) as zf:
+            return inspect(zf)
+    finally:
+        if position is not None:
+            source.seek(position)
+
+
+def sheet_dimension(source):
+    """Estimate the size of the first worksheet from the xlsx metadata only.
+
+    Reads the zip directory and the <dimension> tag at the start of the sheet
+    XML without parsing any cells. Returns a dict with the file 'bytes', the
+    uncompressed 'xml_bytes' of the sheet, its 'rows' and 'cols' and the
+    estimated 'cells' count. source is a path or a seekable binary file
+    object; its position is kept.
+    """
+    rows, cols, cells, xml_bytes = _open_source(source, lambda zf: _sheet_size(zf, first_sheet_path(zf)))
+    return {
+        'bytes': source_size(source),
+        'xml_bytes': xml_bytes,
+        'rows': rows,
+        'cols': cols,
+        'cells': cells,
+    }
+
+
+def inspect_workbook(source):
+    """Return sheet_dimension plus the first sheet's 'header' row and the 'shared_strings'.
+
+    'inline_strings' tells whether the sheet keeps its text inline instead of
+    in the shared strings table. Only the zip directory, the shared strings
+    table and the start of the first sheet are read.
+    """
+    def inspect(zf):
+        sheet_path = first_sheet_path(zf)
+        rows, cols, cells, xml_bytes = _sheet_size(zf, sheet_path)
+        shared_strings = read_shared_strings(zf)
+        # Writers use inline strings for the whole sheet or not at all
+        with zf.open(sheet_path) as sheet_xml:
+            inline_strings = b't="inlineStr"' in sheet_xml.read(DIMENSION_SCAN_BYTES)
+        return {
+            'bytes': source_size(source),
+            'xml_bytes': xml_bytes,
+            'rows': rows,
+            'cols': cols,
+            'cells': cells,
+            'header': read_header_row(zf, sheet_path, shared_strings),
+            'shared_strings': shared_strings,
+            'inline_strings': inline_strings,
+        }
+
+    return _open_source(source, inspect)
+
+
+def sheet_contains_text(source, words):
+    """Return True if any of words appears, case-insensitively, in the first sheet's XML.
+
+    For sheets with inline strings, whose text is not in the shared strings
+    table. Tag and attribute names are scanned too, so a match is a hint
+    rather than proof.
+    """
+    return _open_source(source, lambda zf: _sheet_contains(zf, first_sheet_path(zf), words))